@@ -5,17 +5,116 @@ Created on Wed May 15 15:41:14 2019
 @author: v.shkaberda
 """
 
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
 from contextlib import suppress
 import tkinter as tk
-import re
+
+
+# cyrillic letters looking like latin ones
+CYR_TO_LAT = str.maketrans('КЕНЗХВАРОСМТ', 'KEH3XBAPOCMT')
+# the last line of listbox if not all suggestions are shown
+MORE_MARKER = 'ещё…'
+
+
+class SubstringIndex(object):
+    """ Precomputed index to find items containing given substring.
+
+    Items are normalized with CYR_TO_LAT. Every n-gram of an item refers
+    to the array of item positions, so query is checked only against
+    items containing its rarest n-gram. Shorter queries match too many
+    items to need an index, they are checked against items in order until
+    limit is reached. Prefix matches are found by bisecting sorted items
+    and go first in the result.
+    It may be built in worker thread and given to AutocompleteEntry.
+    """
+    def __init__(self, items, n=3):
+        self.items = list(items)
+        self.n = n
+        self._keys = [item.translate(CYR_TO_LAT) for item in self.items]
+        self._sorted = sorted(range(len(self._keys)),
+                              key=self._keys.__getitem__)
+        self._sorted_keys = [self._keys[i] for i in self._sorted]
+        grams = defaultdict(lambda: array('I'))
+        for i, key in enumerate(self._keys):
+            for gram in {key[j:j+n] for j in range(len(key) - n + 1)}:
+                grams[gram].append(i)
+        self._grams = dict(grams)
+
+    def search(self, text, limit=None, within=None):
+        """ Returns items containing text: prefix matches sorted
+            alphabetically, then other matches in initial order.
+        """
+        return [self.items[i] for i in
+                self.search_positions(text, limit, within)]
+
+    def search_positions(self, text, limit=None, within=None):
+        """ The same as search, but returns positions of items.
+
+            within: positions returned by previous not truncated search
+                for a prefix of text; they are narrowed instead of
+                searching through all items.
+        """
+        query = text.strip().translate(CYR_TO_LAT)
+        if not query:
+            return []
+        if within is not None:
+            keys = self._keys
+            result = [i for i in within if keys[i].startswith(query)]
+            result.extend(sorted(i for i in within if query in keys[i]
+                                 and not keys[i].startswith(query)))
+            return result[:limit]
+        result = []
+        pos = bisect_left(self._sorted_keys, query)
+        while (pos < len(self._sorted_keys) and len(result) != limit
+               and self._sorted_keys[pos].startswith(query)):
+            result.append(self._sorted[pos])
+            pos += 1
+        if len(result) == limit:
+            return result
+        if len(query) < self.n:
+            candidates = range(len(self._keys))
+        elif len(query) == self.n:
+            candidates = self._grams.get(query, ())
+        else:
+            candidates = min((self._grams.get(query[j:j+self.n], ())
+                              for j in range(len(query) - self.n + 1)),
+                             key=len)
+        for i in candidates:
+            key = self._keys[i]
+            if query in key and not key.startswith(query):
+                result.append(i)
+                if len(result) == limit:
+                    break
+        return result
+
+
+# the last built index, since the same list is used by every form
+_last_index = None
+
+
+def get_index(lista):
+    """ Returns SubstringIndex for lista, reuses the last built one. """
+    global _last_index
+    if _last_index is None or _last_index.items != lista:
+        _last_index = SubstringIndex(lista)
+    return _last_index
 
 
 class AutocompleteEntry(tk.Entry):
-    def __init__(self, lista, *args, **kwargs):
+    def __init__(self, lista, *args, limit=100, delay=150, index=None,
+                 **kwargs):
+        """ index - SubstringIndex of lista built beforehand or None
+            (it's built here).
+        """
 
         self.parent = args[0]
         tk.Entry.__init__(self, *args, **kwargs)
         self.lista = lista
+        self.limit = limit  # max number of suggestions
+        self.delay = delay  # ms to wait for the next keystroke
+        self.index = index if index is not None else get_index(lista)
         self.var = self["textvariable"]
         if self.var == '':
             self.var = self["textvariable"] = tk.StringVar()
@@ -24,38 +123,60 @@ class AutocompleteEntry(tk.Entry):
         self.bind("<Return>", self.selection)
         self.bind("<Up>", self.up)
         self.bind("<Down>", self.down)
+        self.bind("<Destroy>", lambda e: self._cancel_update(), '+')
 
         self.lb_up = False
+        self._after_id = None  # scheduled listbox update
+        # the last query and positions found if they weren't truncated
+        self._query = None
+        self._found = None
+        self._words = None  # words shown in listbox
 
-    def changed(self, name, index, mode):
+    def _cancel_update(self):
+        if self._after_id is not None:
+            self.after_cancel(self._after_id)
+            self._after_id = None
+
+    def _update_listbox(self):
+        self._after_id = None
+        words = self.comparison()
+        if not words:
+            self.destroy_listbox()
+            return
+        if len(words) > self.limit:
+            words = words[:self.limit] + [MORE_MARKER]
+        if not self.lb_up:
+            self.lb = tk.Listbox(self.parent, name='!lbox')
+            self.lb.bind("<Double-Button-1>", self.selection)
+            self.lb.bind("<Right>", self.selection)
+            self.lb.place(x=self.winfo_x(), y=self.winfo_y()+self.winfo_height())
+            self.lb_up = True
+        if words != self._words:
+            self.lb.delete(0, tk.END)
+            self.lb.insert(tk.END, *words)
+            self._words = words
 
-        if self.var.get() == '':
+    def changed(self, name, index, mode):
+        text = self.var.get()
+        # translate cyrillic to latin, the trace fires again after set
+        translated = text.strip().translate(CYR_TO_LAT)
+        if translated != text:
+            self.var.set(translated)
+            return
+        self._cancel_update()
+        if text == '':
             self.destroy_listbox()
         else:
-            # translate cyrillic to latin
-            sn_ = self.var
-            sn_.set(sn_.get().strip().translate(str.maketrans('КЕНЗХВАРОСМТ',
-                                                              'KEH3XBAPOCMT')))
-            words = self.comparison()
-            if words:
-                if not self.lb_up:
-                    self.lb = tk.Listbox(self.parent, name='!lbox')
-                    self.lb.bind("<Double-Button-1>", self.selection)
-                    self.lb.bind("<Right>", self.selection)
-                    self.lb.place(x=self.winfo_x(), y=self.winfo_y()+self.winfo_height())
-                    self.lb_up = True
-
-                self.lb.delete(0, tk.END)
-                for w in words:
-                    self.lb.insert(tk.END, w)
-            else:
-                if self.lb_up:
-                    self.destroy_listbox()
+            # coalesce fast typing (or scanner input) into one update
+            self._after_id = self.after(self.delay, self._update_listbox)
 
     def selection(self, event):
 
         if self.lb_up:
-            self.var.set(self.lb.get(tk.ACTIVE))
+            value = self.lb.get(tk.ACTIVE)
+            if value == MORE_MARKER:
+                return
+            self.var.set(value)
             self.destroy_listbox()
             self.selection_clear()
             self.icursor(tk.END)
@@ -86,17 +207,66 @@ class AutocompleteEntry(tk.Entry):
                 self.lb.activate(index)
 
     def comparison(self):
-        pattern = re.compile('.*' + self.var.get() + '.*')
-        return [w for w in self.lista if re.match(pattern, w)]
+        """ Returns up to limit + 1 suggestions, so the extra one shows
+            that the list is truncated.
+        """
+        query = self.var.get()
+        within = None
+        if self._query is not None and query.startswith(self._query):
+            within = self._found
+        found = self.index.search_positions(query, self.limit + 1, within)
+        if len(found) > self.limit:
+            self._query, self._found = None, None
+        else:
+            self._query, self._found = query, found
+        return [self.index.items[i] for i in found]
 
     def destroy_listbox(self):
+        self._cancel_update()
         with suppress(AttributeError):
             self.lb.destroy()
         self.lb_up = False
+        self._words = None
+
+
 
+def benchmark_search(size=50000):
+    """ Print time of SubstringIndex queries for list of serial numbers. """
+    from random import choice, seed
+    from time import perf_counter
+    seed(0)
+    chars = '0123456789ABCDEFKMPX-'
+    lista = [''.join(choice(chars) for _ in range(12)) for _ in range(size)]
+    start = perf_counter()
+    index = SubstringIndex(lista)
+    print('Index built: {:.0f} ms'.format((perf_counter() - start) * 1000))
+    for query in ('A', 'A1', 'A1B', 'A1B2', lista[0][3:9], 'А1(+'):
+        start = perf_counter()
+        found = index.search(query, limit=100)
+        print('{:>12} {:>4} found {:.3f} ms'.format(
+            query, len(found), (perf_counter() - start) * 1000))
+        normalized = query.translate(CYR_TO_LAT)
+        expected = [w for w in lista if normalized in w]
+        assert set(found) <= set(expected)
+        assert len(found) == min(100, len(expected))
+        # prefix matches go first
+        prefix = [w.startswith(normalized) for w in found]
+        assert prefix == sorted(prefix, reverse=True)
+    # narrowing of the previous complete result gives the same items
+    query = lista[0][3:6]
+    found = index.search_positions(query)
+    start = perf_counter()
+    narrowed = index.search_positions(query + lista[0][6], within=found)
+    print('{:>12} {:>4} narrowed {:.3f} ms'.format(
+        query + lista[0][6], len(narrowed), (perf_counter() - start) * 1000))
+    assert narrowed == index.search_positions(query + lista[0][6])
 
 
 if __name__ == '__main__':
+    import sys
+    if '--bench' in sys.argv:
+        benchmark_search()
+        sys.exit()
     root = tk.Tk()
 
     lista = ['a', 'actions', 'additional', 'also', 'an', 'and', 'angle', 'are',
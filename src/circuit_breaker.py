@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Feb 10 10:02:48 2020
+
+@author: v.shkaberda
+"""
+from random import uniform
+from time import monotonic
+import threading
+
+
+def backoff_delays(retries, base=0.25, cap=2.0):
+    """ Returns list of delays (sec) before retries: exponential backoff
+        with full jitter, i-th delay is random in [0, min(cap, base * 2**i)].
+    """
+    return [uniform(0, min(cap, base * 2 ** i)) for i in range(retries)]
+
+
+class CircuitBreaker(object):
+    """ Stops calls to server after repeated failures.
+
+    After failure_threshold failed calls in a row breaker is open and
+    calls fail fast. When reset_timeout seconds have passed one trial
+    call is allowed (half-open): its success closes breaker, its failure
+    opens breaker again. If trial call reports nothing for reset_timeout
+    seconds, the next one is allowed.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failure_threshold=2, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at = None
+        self._trial_at = None  # start of trial call in half-open state
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        """ True if server is considered unreachable (open or half-open). """
+        return self._opened_at is not None
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if monotonic() - self._opened_at < self.reset_timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow(self):
+        """ Check if call may be made now. """
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and (
+                    self._trial_at is None
+                    or monotonic() - self._trial_at >= self.reset_timeout):
+                self._trial_at = monotonic()
+                return True
+            return False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if (self._trial_at is not None
+                    or self.failures >= self.failure_threshold):
+                self._opened_at = monotonic()
+                self._trial_at = None
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._trial_at = None
+
+
+if __name__ == '__main__':
+    from time import sleep
+
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+    breaker.record_failure()
+    assert breaker.allow(), 'Opened too early.'
+    breaker.record_failure()
+    assert not breaker.allow(), 'Not opened after failures.'
+    sleep(0.15)
+    assert breaker.allow() and not breaker.allow(), 'One trial is expected.'
+    sleep(0.15)
+    assert breaker.allow(), 'Lost trial must be allowed again.'
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN, 'Failed trial must open breaker.'
+    sleep(0.15)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED and breaker.allow()
+    assert all(0 <= d <= min(2.0, 0.25 * 2 ** i)
+               for i, d in enumerate(backoff_delays(5)))
+    print('Circuit breaker works.')
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Jan 13 10:12:31 2020
+
+@author: v.shkaberda
+"""
+from time import monotonic
+import threading
+
+
+class PoolTimeoutError(Exception):
+    """ Exception raised if no connection became free in time.
+
+    Attributes:
+        expression - input expression in which the error occurred;
+        message - explanation of the error.
+    """
+    def __init__(self, expression,
+                 message='No free connection in the pool'):
+        self.expression = expression
+        self.message = message
+        super().__init__(self.expression, self.message)
+
+
+class PoolStats(object):
+    """ Counters used to size the pool.
+
+    hits - connection was taken from idle ones;
+    misses - new connection had to be opened;
+    waits - caller had to wait for a connection to be released;
+    wait_time - total time (sec) spent waiting;
+    broken - connections discarded after failed health check or network error;
+    evicted - connections closed after staying idle too long.
+    """
+    __slots__ = ('hits', 'misses', 'waits', 'wait_time', 'broken', 'evicted')
+
+    def __init__(self):
+        for attr in self.__slots__:
+            setattr(self, attr, 0)
+
+    def as_dict(self):
+        return {attr: getattr(self, attr) for attr in self.__slots__}
+
+
+class ConnectionPool(object):
+    """ Small bounded pool of db connections.
+
+    connect - callable without arguments that opens new connection;
+    maxsize - int, max number of simultaneously opened connections;
+    idle_timeout - int, seconds after which idle connection is closed;
+    check_after - int, idle connection older than this (sec) is pinged
+        before being returned to caller.
+    """
+    def __init__(self, connect, *, maxsize=4, idle_timeout=300,
+                 check_after=30):
+        self._connect = connect
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self._idle = []  # (connection, release time), the last is the newest
+        self._size = 0  # idle connections + connections in use
+        self._cond = threading.Condition()
+        self.stats = PoolStats()
+
+    def _evict_idle(self):
+        """ Close connections that stayed idle too long. Lock must be held.
+        """
+        now = monotonic()
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.pop(0)
+            self._size -= 1
+            self.stats.evicted += 1
+            self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _is_alive(conn):
+        try:
+            conn.cursor().execute('select 1').fetchone()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        self._close(conn)
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def acquire(self, timeout=None):
+        """ Returns opened connection.
+            Raises PoolTimeoutError if pool is exhausted for timeout seconds.
+        """
+        start = monotonic()
+        waited = False
+        with self._cond:
+            while True:
+                self._evict_idle()
+                if self._idle:
+                    conn, released = self._idle.pop()
+                    break
+                if self._size < self.maxsize:
+                    conn, released = None, None
+                    self._size += 1
+                    break
+                waited = True
+                remaining = (None if timeout is None
+                             else timeout - (monotonic() - start))
+                if remaining is not None and remaining <= 0:
+                    raise PoolTimeoutError(self)
+                self._cond.wait(remaining)
+            if waited:
+                self.stats.waits += 1
+                self.stats.wait_time += monotonic() - start
+
+        # stats are changed under lock, pool is shared by worker threads
+        if conn is not None:
+            if (monotonic() - released < self.check_after
+                    or self._is_alive(conn)):
+                with self._cond:
+                    self.stats.hits += 1
+                return conn
+            # the link is broken, open new connection instead
+            with self._cond:
+                self.stats.broken += 1
+            self._close(conn)
+
+        with self._cond:
+            self.stats.misses += 1
+        try:
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn, broken=False):
+        """ Return connection to the pool or close it if it's broken.
+        """
+        if not broken:
+            try:
+                # drop unfinished transaction before reuse
+                conn.rollback()
+            except Exception:
+                broken = True
+        if broken:
+            with self._cond:
+                self.stats.broken += 1
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, monotonic()))
+            self._cond.notify()
+
+    def close(self):
+        """ Close all idle connections.
+        """
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for conn, _ in idle:
+            self._close(conn)
+
+
+if __name__ == '__main__':
+    class FakeConnection(object):
+        def close(self):
+            pass
+
+        def rollback(self):
+            pass
+
+    pool = ConnectionPool(FakeConnection, maxsize=2)
+    for _ in range(5):
+        conn = pool.acquire()
+        pool.release(conn)
+    assert pool.stats.misses == 1 and pool.stats.hits == 4, pool.stats.as_dict()
+    print(pool.stats.as_dict())
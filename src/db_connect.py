@@ -4,29 +4,154 @@ Created on Wed Nov 20 11:40:43 2019
 
 @author: v.shkaberda
 """
+from circuit_breaker import backoff_delays, CircuitBreaker
+from collections import namedtuple
+from connection_pool import ConnectionPool
+from db_metrics import Call, DBMetrics, TimedCursor
 from functools import wraps
-from tkRepairs import NetworkError
+from time import perf_counter, sleep
+from uuid import UUID, uuid5
 import pyodbc
+import threading
+
+# SQLSTATE codes that mean the link to server is lost
+NETWORK_ERRORS = ('01000', '08S01', '08001')
+
+# methods that change data, they are retried after network error only
+# if request_key is given (server ignores repeated request with same key);
+# fetch_rows continues result of previous request, so it's never retried
+UNSAFE_TO_RETRY = ('add_movement', 'create_repair', 'create_repairs',
+                   'fetch_rows', 'raw_query', 'update_repair')
+
+# methods raising errors of reachable server (other methods return None):
+# app can't start without result of bootstrap, batch rejected by server
+# is told apart from network error (None) in import
+RAISE_SERVER_ERRORS = ('bootstrap', 'create_repairs')
+
+# max number of repairs in one batch of create_repairs (12 parameters
+# for every repair, server accepts up to 2100 parameters in request)
+MAX_BATCH = 170
+
+UserInfo = namedtuple('UserInfo', ['UserID', 'ShortUserName',
+                                   'AccessType', 'isSuperUser'])
+
+# Everything needed to start app, see DBConnect.bootstrap
+Bootstrap = namedtuple('Bootstrap', ['version', 'access_permitted',
+                                     'user_info', 'references',
+                                     'references_versions'])
+
+
+class StreamInterruptedError(Exception):
+    """ Exception raised by generators of rows (e.g. iter_repair_list)
+        if rows can't be fetched till the end because of network error.
+    """
+
+
+class OfflineError(pyodbc.OperationalError):
+    """ Exception raised instead of calling server while circuit breaker
+        is open (server is considered unreachable).
+    """
+    def __init__(self):
+        super().__init__('08S01', 'Server is unreachable, calls are stopped')
+
+
+def _is_access_permitted(access):
+    """ Check AccessType and isSuperUser returned by Access_Check. """
+    return bool(access and (access[0] in (1, 2, 3) or access[1]))
+
+
+def batch_request_key(request_key, i):
+    """ Returns request key of i-th repair of batch with request_key. """
+    return str(uuid5(UUID(request_key), str(i)))
+
+
+def _is_network_error(e):
+    return bool(e.args) and e.args[0] in NETWORK_ERRORS
 
 
 def monitor_network_state(method):
-    """ Show error message in case of network error.
+    """ Retry method on a new connection after network error (with
+        exponential backoff and jitter). If all attempts fail, error is
+        reported to DBConnect.on_network_error or raised if no handler is set.
+        While circuit breaker is open method returns None at once
+        (OfflineError is raised if no handler is set).
+        Other errors of server are ignored (method returns None) except
+        for methods in RAISE_SERVER_ERRORS.
+        Durations, rows and error codes of the call are added to
+        DBConnect.metrics under the name of method.
     """
     @wraps(method)
     def wrapper(self, *args, **kwargs):
+        call = Call(connect=self._take_connect_time())
+        previous, self._local.call = getattr(self._local, 'call', None), call
+        retryable = (method.__name__ not in UNSAFE_TO_RETRY
+                     or kwargs.get('request_key') is not None)
+        delays = backoff_delays(self.retries if retryable else 0,
+                                self.retry_delay)
+        error = None
         try:
-            return method(self, *args, **kwargs)
-        except pyodbc.Error as e:
-            # Network error
-            if e.args[0] in ('01000', '08S01', '08001'):
-                NetworkError()
+            # connection of context is missing and server is unreachable
+            if self._local.stack[-1][2] and not self.breaker.allow():
+                call.error = 'offline'
+                if self.on_network_error is None:
+                    raise OfflineError()
+                return
+            for delay in delays + [None]:
+                try:
+                    if self._local.stack[-1][2]:
+                        self._reconnect()
+                        call.connect += self._take_connect_time()
+                    result = method(self, *args, **kwargs)
+                except pyodbc.Error as e:
+                    if call.error is None:
+                        call.error = e.args[0] if e.args else type(e).__name__
+                    if not _is_network_error(e):
+                        # server is reachable, error is ignored as before
+                        self.breaker.record_success()
+                        if method.__name__ in RAISE_SERVER_ERRORS:
+                            raise
+                        return
+                    error = e
+                    # don't return broken connection into the pool
+                    self._mark_broken()
+                else:
+                    self.breaker.record_success()
+                    return result
+                if delay is not None:
+                    sleep(delay)
+            self.breaker.record_failure()
+            if self.on_network_error is None:
+                raise error
+            self.on_network_error(error)
+        finally:
+            self._local.call = previous
+            self.metrics.record(method.__name__, call)
     return wrapper
 
 
 class DBConnect(object):
     """ Provides connection to database and functions to work with server.
+
+    on_network_error: function called with pyodbc.Error in case of network
+        error (method returns None then), it may be called from any thread
+        that uses connection. If None - error is raised.
+
+    retries: int, number of retries after network error (on a new
+        connection), delays grow from retry_delay (sec).
+
+    breaker: CircuitBreaker, opens after failure_threshold calls failed
+        in a row; then calls fail fast for reset_timeout seconds.
+
+    idempotency_keys: bool, True if server procedures of changing data
+        accept @RequestKey and ignore repeated requests with the same key.
+
+    metrics: DBMetrics, latency and volume of every procedure called,
+        time of getting connection is added to the next call in context.
     """
-    def __init__(self, *, server, db):
+    def __init__(self, *, server, db, pool_size=4, idle_timeout=300,
+                 pool_timeout=30, connect_timeout=5, retries=2,
+                 retry_delay=0.25, failure_threshold=2, reset_timeout=30,
+                 idempotency_keys=False):
         self._server = server
         self._db = db
         # Connection properties
@@ -36,14 +161,120 @@ class DBConnect(object):
             'Database={1};'
             'Trusted_Connection=yes;'.format(self._server, self._db)
         )
+        self.pool = ConnectionPool(
+            lambda: pyodbc.connect(self.conn_str, timeout=connect_timeout),
+            maxsize=pool_size, idle_timeout=idle_timeout)
+        self.pool_timeout = pool_timeout
+        self.on_network_error = None
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.idempotency_keys = idempotency_keys
+        self.metrics = DBMetrics()
+        # every thread keeps a stack of its own (connection, cursor, broken)
+        self._local = threading.local()
 
     def __enter__(self):
-        self.__db = pyodbc.connect(self.conn_str)
-        self.__cursor = self.__db.cursor()
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+            self._local.connect_time = 0.0
+        # without connection (methods will reconnect or fail fast)
+        entry = [None, None, True]
+        if self.breaker.state != CircuitBreaker.OPEN:
+            try:
+                entry = self._open()
+            except pyodbc.Error as e:
+                # e.g. login failed
+                if not _is_network_error(e):
+                    raise
+        self._local.stack.append(entry)
         return self
 
     def __exit__(self, type, value, traceback):
-        self.__db.close()
+        db, cursor, broken = self._local.stack.pop()
+        if db is None:
+            return
+        if isinstance(value, pyodbc.Error) and _is_network_error(value):
+            broken = True
+        self._release(db, cursor, broken)
+
+    @property
+    def __db(self):
+        return self._local.stack[-1][0]
+
+    @property
+    def __cursor(self):
+        return self._local.stack[-1][1]
+
+    def _open(self):
+        """ Returns [connection, cursor, broken] for stack of contexts.
+        """
+        start = perf_counter()
+        try:
+            db = self.pool.acquire(timeout=self.pool_timeout)
+            try:
+                cursor = TimedCursor(db.cursor(), self._current_call)
+            except pyodbc.Error:
+                self.pool.release(db, broken=True)
+                raise
+        except Exception as e:
+            call = Call(connect=(perf_counter() - start) * 1000)
+            call.error = e.args[0] if e.args else type(e).__name__
+            self.metrics.record('connect', call)
+            raise
+        finally:
+            self._local.connect_time += (perf_counter() - start) * 1000
+        return [db, cursor, False]
+
+    def _reconnect(self):
+        """ Replace connection of the current context by a new one.
+            Idle connections are closed too, since they are likely to be
+            broken as well.
+        """
+        stack = self._local.stack
+        db, cursor, _ = stack[-1]
+        stack[-1] = [None, None, True]
+        if db is not None:
+            self._release(db, cursor, broken=True)
+        self.pool.close()
+        stack[-1] = self._open()
+
+    def _release(self, db, cursor, broken):
+        try:
+            cursor.close()
+        except pyodbc.Error:
+            broken = True
+        self.pool.release(db, broken=broken)
+
+    def _current_call(self):
+        """ Returns Call of the method running in the current thread.
+        """
+        return getattr(self._local, 'call', None)
+
+    def _take_connect_time(self):
+        """ Returns time (ms) spent on getting connection since the
+            previous call in the current thread.
+        """
+        connect_time = getattr(self._local, 'connect_time', 0.0)
+        self._local.connect_time = 0.0
+        return connect_time
+
+    def _mark_broken(self):
+        """ Mark connection of the current context as broken.
+        """
+        stack = getattr(self._local, 'stack', None)
+        if stack:
+            stack[-1][2] = True
+
+    def close(self):
+        """ Close all idle connections of the pool.
+        """
+        self.pool.close()
+
+    def pool_stats(self):
+        """ Returns dict with pool statistics (hits, misses, wait time etc.).
+        """
+        return self.pool.stats.as_dict()
 
     @monitor_network_state
     def add_movement(self, UserID, ID, SN, ObjectID, date_movement):
@@ -69,8 +300,12 @@ class DBConnect(object):
     def create_repair(self, *, userID, SN, date_broken,
                       date_repair_finished, OutfitOrder, WorkingHours,
                       UnitOfMeasureID, NumberOfUnits, FaultDescription,
-                      PerformedWork, statusID):
+                      PerformedWork, statusID, request_key=None):
         """ Executes procedure that creates new repair.
+
+            request_key: str or None, if given - it's sent as @RequestKey,
+                server creates repair once for the key, so request is
+                retried after network error.
         """
         query = '''
         exec technics.CREATE_REPAIR @UserID = ?,
@@ -85,17 +320,69 @@ class DBConnect(object):
                                     @PerformedWork = ?,
                                     @StatusID = ?
             '''
+        params = [userID, SN, date_broken, date_repair_finished, OutfitOrder,
+                  WorkingHours, UnitOfMeasureID, NumberOfUnits,
+                  FaultDescription, PerformedWork, statusID]
+        if request_key is not None:
+            query += ', @RequestKey = ?'
+            params.append(request_key)
         try:
-            self.__cursor.execute(query, userID, SN, date_broken,
-                      date_repair_finished, OutfitOrder, WorkingHours,
-                      UnitOfMeasureID, NumberOfUnits, FaultDescription,
-                      PerformedWork, statusID)
+            self.__cursor.execute(query, *params)
             request_success = self.__cursor.fetchone()[0]
             self.__db.commit()
             return request_success
         except pyodbc.ProgrammingError:
             return
 
+    @monitor_network_state
+    def create_repairs(self, repairs, *, userID, statusID, request_key=None):
+        """ Creates repairs by one batch (one round trip) in one transaction.
+            Returns list of results of CREATE_REPAIR (1 - created) for every
+            repair. If any repair isn't created, transaction is rolled back.
+
+            repairs: list of dicts with the same keys as arguments of
+                create_repair (up to MAX_BATCH).
+            request_key: str (uuid) or None, if given - i-th repair is sent
+                with batch_request_key(request_key, i), so batch is retried
+                after network error.
+            Error raised by server (e.g. constraint) is raised after
+            rollback, None is returned only after network error.
+        """
+        query = '''
+        exec technics.CREATE_REPAIR @UserID = ?, @SN  = ?, @date_broken = ?,
+            @date_repair_finished = ?, @OutfitOrder = ?, @WorkingHours = ?,
+            @UnitOfMeasureID = ?, @NumberOfUnits = ?, @FaultDescription = ?,
+            @PerformedWork = ?, @StatusID = ?'''
+        if request_key is not None:
+            query += ', @RequestKey = ?'
+        params = []
+        for i, repair in enumerate(repairs):
+            params.extend((userID, repair['SN'], repair['date_broken'],
+                           repair['date_repair_finished'],
+                           repair['OutfitOrder'], repair['WorkingHours'],
+                           repair['UnitOfMeasureID'], repair['NumberOfUnits'],
+                           repair['FaultDescription'], repair['PerformedWork'],
+                           statusID))
+            if request_key is not None:
+                params.append(batch_request_key(request_key, i))
+        results = []
+        try:
+            self.__cursor.execute(';'.join([query] * len(repairs)), *params)
+            for i in range(len(repairs)):
+                self._next_rows(first=not i)
+                results.append(self.__cursor.fetchone()[0])
+        except pyodbc.Error:
+            try:
+                self.__db.rollback()
+            except pyodbc.Error:
+                pass  # link is lost, server rolls transaction back itself
+            raise
+        if all(result == 1 for result in results):
+            self.__db.commit()
+        else:
+            self.__db.rollback()
+        return results
+
     @monitor_network_state
     def access_check(self):
         """ Check user permission.
@@ -103,10 +390,63 @@ class DBConnect(object):
         """
         self.__cursor.execute("exec [technics].[Access_Check]")
         access = self.__cursor.fetchone()
-        # check AccessType and isSuperUser
-        if access and (access[0] in (1, 2, 3) or access[1]):
+        if _is_access_permitted(access):
             return True
 
+    def _next_rows(self, first=False):
+        """ Move cursor to the next result set containing rows,
+            results without columns (row counts) are skipped.
+        """
+        if not first and not self.__cursor.nextset():
+            raise pyodbc.ProgrammingError('HY000', 'Result set is missing')
+        while self.__cursor.description is None:
+            if not self.__cursor.nextset():
+                raise pyodbc.ProgrammingError('HY000',
+                                              'Result set is missing')
+
+    @monitor_network_state
+    def bootstrap(self, *, with_references=True, with_versions=False):
+        """ Returns Bootstrap with everything needed to start app
+            using single batch (one round trip):
+            - version supposed to be the same as client version;
+            - access_permitted, bool;
+            - user_info, UserInfo;
+            - references, rows of get_references or None
+                if with_references is False;
+            - references_versions, dict (see get_references_versions),
+                empty if with_versions is False or server doesn't
+                provide versions.
+        """
+        batch = ['exec [technics].[get_version_for_comparison]',
+                 'exec [technics].[Access_Check]',
+                 'exec [technics].[get_user_info]']
+        if with_references:
+            batch.append('exec [technics].[get_references]')
+        # the last one, since procedure may be absent on server
+        if with_versions:
+            batch.append('exec [technics].[get_references_versions]')
+        self.__cursor.execute(';\n'.join(batch))
+        self._next_rows(first=True)
+        version = tuple(self.__cursor.fetchone())
+        self._next_rows()
+        access_permitted = _is_access_permitted(self.__cursor.fetchone())
+        self._next_rows()
+        user_info = UserInfo(*self.__cursor.fetchone())
+        references = None
+        if with_references:
+            self._next_rows()
+            references = self.__cursor.fetchall()
+        versions = {}
+        if with_versions:
+            try:
+                self._next_rows()
+                versions = dict((name, version_) for name, version_
+                                in self.__cursor.fetchall())
+            except pyodbc.ProgrammingError:
+                pass
+        return Bootstrap(version, access_permitted, user_info, references,
+                         versions)
+
     @monitor_network_state
     def get_object_owner_info(self, sn, date_broken):
         """ Returns unis of measure list.
@@ -117,6 +457,18 @@ class DBConnect(object):
         self.__cursor.execute(query, sn, date_broken)
         return self.__cursor.fetchall()
 
+    @monitor_network_state
+    def get_object_owner_history(self, sn):
+        """ Returns history of owner, rc and store of technics, rows
+            (date_from, date_to, owner, rc, store) ordered as rows of
+            get_object_owner_info; date_to is None for current owner.
+        """
+        query = '''
+        exec [technics].[get_object_owner_history] @SN = ?
+        '''
+        self.__cursor.execute(query, sn)
+        return self.__cursor.fetchall()
+
     @monitor_network_state
     def get_current_repair(self, repairID):
         """ Returns info about repairID.
@@ -148,6 +500,19 @@ class DBConnect(object):
         self.__cursor.execute("exec [technics].[get_references]")
         return self.__cursor.fetchall()
 
+    @monitor_network_state
+    def get_references_versions(self):
+        """ Returns dict {reference set name: version token}.
+            Token is changed on server when reference set is changed.
+            Empty dict is returned if server doesn't provide versions.
+        """
+        try:
+            self.__cursor.execute("exec [technics].[get_references_versions]")
+        except pyodbc.ProgrammingError:
+            return {}
+        return dict((name, version) for name, version
+                    in self.__cursor.fetchall())
+
     @monitor_network_state
     def get_repair_list(self, *, created_by, rc, store, owner, mfr,
                         tech_type, status):
@@ -167,6 +532,109 @@ class DBConnect(object):
                               tech_type, status)
         return self.__cursor.fetchall()
 
+    @monitor_network_state
+    def fetch_rows(self, size):
+        """ Returns up to size rows of result of the previous request,
+            empty list if all rows have been fetched.
+        """
+        return self.__cursor.fetchmany(size)
+
+    def iter_repair_list(self, *, created_by, rc, store, owner, mfr,
+                         tech_type, status, batch_size=1000, first_size=None):
+        """ Generator of repair list (see get_repair_list) yielding lists
+            of up to batch_size rows, so the whole list isn't kept in memory.
+            It must be consumed inside the same context (with DBConnect).
+            first_size - int or None, size of the first batch if it has
+                to be got faster than the others (e.g. to be shown at once).
+            Raises StreamInterruptedError if network error occurred
+            (the error is reported as usual).
+        """
+        if not self.start_repair_list(created_by=created_by, rc=rc,
+                                      store=store, owner=owner, mfr=mfr,
+                                      tech_type=tech_type, status=status):
+            raise StreamInterruptedError()
+        yield from self._iter_fetched(batch_size, first_size)
+
+    def iter_repair_changes(self, modified_since, batch_size=1000):
+        """ Generator of repairs changed since modified_since (all repairs
+            if it's None) yielding lists of rows of repair list with
+            modification time and deletion flag added, rows are ordered
+            by modification time. See iter_repair_list.
+        """
+        if not self.start_repair_changes(modified_since):
+            raise StreamInterruptedError()
+        yield from self._iter_fetched(batch_size)
+
+    def _iter_fetched(self, batch_size, first_size=None):
+        """ Yields rows of the previous request by batches. """
+        size = first_size or batch_size
+        while True:
+            rows = self.fetch_rows(size)
+            size = batch_size
+            if rows is None:
+                raise StreamInterruptedError()
+            if not rows:
+                return
+            yield rows
+
+    @monitor_network_state
+    def start_repair_changes(self, modified_since):
+        """ Executes procedure of changed repairs without fetching rows
+            (see fetch_rows). Returns True.
+        """
+        query = '''
+        exec technics.get_repair_list_changes @modified_since = ?
+        '''
+        self.__cursor.execute(query, modified_since)
+        return True
+
+    @monitor_network_state
+    def start_repair_list(self, *, created_by, rc, store, owner, mfr,
+                          tech_type, status):
+        """ Executes procedure of repair list without fetching rows
+            (see fetch_rows). Returns True.
+        """
+        query = '''
+        exec technics.get_repair_list @created_by = ?,
+                                      @rc = ?,
+                                      @store = ?,
+                                      @owner = ?,
+                                      @mfr = ?,
+                                      @tech_type = ?,
+                                      @status = ?
+        '''
+        self.__cursor.execute(query, created_by, rc, store, owner, mfr,
+                              tech_type, status)
+        return True
+
+    @monitor_network_state
+    def get_repair_list_page(self, *, created_by, rc, store, owner, mfr,
+                             tech_type, status, page_size, after=None):
+        """ Executes procedure and return one page of repair list.
+            Rows are ordered by creation time and ID descending.
+
+            page_size: int, max number of rows returned.
+            after: tuple (creation time, ID) of the last row of previous
+                page or None to get the first page.
+        """
+        query = '''
+        exec technics.get_repair_list_page @created_by = ?,
+                                           @rc = ?,
+                                           @store = ?,
+                                           @owner = ?,
+                                           @mfr = ?,
+                                           @tech_type = ?,
+                                           @status = ?,
+                                           @page_size = ?,
+                                           @last_created = ?,
+                                           @last_id = ?
+        '''
+        last_created, last_id = after or (None, None)
+        self.__cursor.execute(query, created_by, rc, store, owner, mfr,
+                              tech_type, status, page_size,
+                              last_created, last_id)
+        return self.__cursor.fetchall()
+
     @monitor_network_state
     def get_technics_info(self):
         """ Returns technics info.
@@ -199,8 +667,10 @@ class DBConnect(object):
     def update_repair(self, UserID, RepairID, SN, date_broken,
                       date_repair_finished, OutfitOrder, WorkingHours,
                       UnitOfMeasureID, NumberOfUnits, FaultDescription,
-                      PerformedWork, StatusID):
+                      PerformedWork, StatusID, *, request_key=None):
         """ Executes procedure that updates repair.
+
+            request_key: str or None, see create_repair.
         """
         query = '''
         exec technics.UPDATE_REPAIR @UserID = ?,
@@ -216,11 +686,14 @@ class DBConnect(object):
                                     @PerformedWork = ?,
                                     @StatusID = ?
             '''
+        params = [UserID, RepairID, SN, date_broken, date_repair_finished,
+                  OutfitOrder, WorkingHours, UnitOfMeasureID, NumberOfUnits,
+                  FaultDescription, PerformedWork, StatusID]
+        if request_key is not None:
+            query += ', @RequestKey = ?'
+            params.append(request_key)
         try:
-            self.__cursor.execute(query, UserID, RepairID, SN, date_broken,
-                      date_repair_finished, OutfitOrder, WorkingHours,
-                      UnitOfMeasureID, NumberOfUnits, FaultDescription,
-                      PerformedWork, StatusID)
+            self.__cursor.execute(query, *params)
             request_success = self.__cursor.fetchone()[0]
             self.__db.commit()
             return request_success
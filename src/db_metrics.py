@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Feb  5 14:20:37 2020
+
+@author: v.shkaberda
+
+Latency and volume metrics of db procedures collected by DBConnect.
+"""
+from bisect import bisect_left
+from collections import Counter
+from time import perf_counter
+import json
+import threading
+import time
+
+# upper bounds (ms) of histogram buckets, the last bucket is unbounded
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+PHASES = ('connect', 'execute', 'fetch', 'total')
+
+
+class Histogram(object):
+    """ Number of durations (ms) in fixed buckets. """
+    __slots__ = ('counts', 'sum', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.counts[bisect_left(BUCKETS, ms)] += 1
+        self.sum += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, p):
+        """ Upper bound of bucket containing p-th percentile
+            (max duration for the last bucket).
+        """
+        total = sum(self.counts)
+        if not total:
+            return 0
+        rank = p / 100 * total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else round(self.max)
+        return round(self.max)
+
+    def as_dict(self):
+        return {'buckets': dict(zip(list(BUCKETS) + ['inf'], self.counts)),
+                'sum': round(self.sum, 1), 'max': round(self.max, 1)}
+
+
+class Call(object):
+    """ Durations (ms) and volume of one call of procedure.
+
+    connect - time of getting connections, both before the call started
+        (connect_before) and of reconnects during it.
+    """
+    __slots__ = ('connect', 'connect_before', 'execute', 'fetch', 'rows',
+                 'error', 'started')
+
+    def __init__(self, connect=0.0):
+        self.connect = connect
+        self.connect_before = connect
+        self.execute = 0.0
+        self.fetch = 0.0
+        self.rows = 0
+        self.error = None
+        self.started = perf_counter()
+
+
+class ProcedureMetrics(object):
+    """ Accumulated metrics of one procedure. """
+    def __init__(self):
+        self.calls = 0
+        self.rows = 0
+        self.errors = Counter()  # {SQLSTATE: number of calls}
+        self.histograms = {phase: Histogram() for phase in PHASES}
+
+    def add(self, call, total):
+        self.calls += 1
+        self.rows += call.rows
+        if call.error is not None:
+            self.errors[call.error] += 1
+        for phase, ms in (('connect', call.connect),
+                          ('execute', call.execute),
+                          ('fetch', call.fetch), ('total', total)):
+            self.histograms[phase].add(ms)
+
+    def as_dict(self):
+        return {'calls': self.calls, 'rows': self.rows,
+                'errors': dict(self.errors),
+                **{phase: hist.as_dict()
+                   for phase, hist in self.histograms.items()}}
+
+
+class DBMetrics(object):
+    """ Thread-safe metrics of all procedures called by DBConnect.
+
+    info - dict of additional fields written to dump (user, version).
+    """
+    def __init__(self):
+        self.started = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.info = {}
+        self._lock = threading.Lock()
+        self._procedures = {}
+
+    def record(self, name, call):
+        """ Add finished call of procedure name. """
+        # reconnects are within elapsed time already
+        total = (perf_counter() - call.started) * 1000 + call.connect_before
+        with self._lock:
+            try:
+                procedure = self._procedures[name]
+            except KeyError:
+                procedure = self._procedures[name] = ProcedureMetrics()
+            procedure.add(call, total)
+
+    def as_dict(self):
+        with self._lock:
+            return {'started': self.started,
+                    'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    **self.info,
+                    'procedures': {name: procedure.as_dict() for name,
+                                   procedure in self._procedures.items()}}
+
+    def dump(self, fname, **extra):
+        """ Append metrics as one json line, extra fields are added
+            (e.g. pool statistics).
+        """
+        record = self.as_dict()
+        record.update(extra)
+        with open(fname, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def report(self):
+        """ Returns metrics as text table. """
+        header = '{:<28}{:>7}{:>9}{:>8}{:>9}{:>9}{:>9}{:>9}{:>9}  {}'
+        lines = [header.format('procedure', 'calls', 'rows', 'err',
+                               'conn', 'exec', 'fetch', 'p50', 'p95',
+                               'errors')]
+        with self._lock:
+            for name in sorted(self._procedures):
+                procedure = self._procedures[name]
+                hist = procedure.histograms
+                # average per call for phases, percentiles for total
+                avg = lambda phase: round(hist[phase].sum / procedure.calls)
+                lines.append(header.format(
+                    name, procedure.calls, procedure.rows,
+                    sum(procedure.errors.values()), avg('connect'),
+                    avg('execute'), avg('fetch'),
+                    hist['total'].percentile(50),
+                    hist['total'].percentile(95),
+                    ', '.join('{}: {}'.format(*err) for err
+                              in procedure.errors.most_common())))
+        lines.append('')
+        lines.append('conn, exec, fetch - average time (ms) per call; '
+                     'p50, p95 - total time (ms), upper bound of bucket.')
+        return '\n'.join(lines)
+
+
+class TimedCursor(object):
+    """ Cursor wrapper adding time of execute and fetch methods (and number
+        of fetched rows) to the current call.
+
+    current_call - callable without arguments, returns Call or None.
+    """
+    def __init__(self, cursor, current_call):
+        self.cursor = cursor
+        self.current_call = current_call
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def _timed(self, phase, method, *args):
+        call = self.current_call()
+        if call is None:
+            return method(*args)
+        start = perf_counter()
+        try:
+            return method(*args)
+        except Exception as e:
+            if call.error is None:
+                call.error = e.args[0] if e.args else type(e).__name__
+            raise
+        finally:
+            setattr(call, phase,
+                    getattr(call, phase) + (perf_counter() - start) * 1000)
+
+    def execute(self, *args):
+        self._timed('execute', self.cursor.execute, *args)
+        return self
+
+    def executemany(self, *args):
+        self._timed('execute', self.cursor.executemany, *args)
+        return self
+
+    def fetchall(self):
+        rows = self._timed('fetch', self.cursor.fetchall)
+        self._add_rows(len(rows))
+        return rows
+
+    def fetchmany(self, *args):
+        rows = self._timed('fetch', self.cursor.fetchmany, *args)
+        self._add_rows(len(rows))
+        return rows
+
+    def fetchone(self):
+        row = self._timed('fetch', self.cursor.fetchone)
+        self._add_rows(row is not None)
+        return row
+
+    def nextset(self):
+        return self._timed('fetch', self.cursor.nextset)
+
+    def _add_rows(self, rows):
+        call = self.current_call()
+        if call is not None:
+            call.rows += rows
+
+
+if __name__ == '__main__':
+    from random import expovariate, seed
+
+    seed(0)
+    metrics = DBMetrics()
+    for name, mean in (('get_repair_list', 400), ('get_current_repair', 20),
+                       ('create_repair', 60)):
+        for _ in range(200):
+            call = Call(connect=expovariate(1 / 5))
+            call.execute = expovariate(1 / mean)
+            call.fetch = call.execute / 3
+            call.rows = 1000 if name == 'get_repair_list' else 1
+            call.started -= (call.execute + call.fetch) / 1000
+            metrics.record(name, call)
+    metrics.record('create_repair', Call())
+    # reconnect during call isn't counted in total twice
+    call = Call(connect=5)
+    call.connect += 100
+    call.started -= 0.1
+    metrics.record('reconnected', call)
+    total = metrics.as_dict()['procedures']['reconnected']['total']['sum']
+    assert 105 <= total < 150, total
+    print(metrics.report())
+    assert metrics.as_dict()['procedures']['create_repair']['calls'] == 201
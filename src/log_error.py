@@ -3,24 +3,244 @@
 Created on Thu Aug 30 16:24:54 2018
 
 @author: v.shkaberda
-"""
 
+Errors are put into queue and written to log.txt by background thread,
+so writelog never blocks the caller. Log file is rotated by size
+(and by time if rotate_when is set), see configure().
+"""
+from logging.handlers import QueueHandler, QueueListener
 from os import getcwd, path
+import atexit
+import logging
+import os
+import queue
+import re
+import threading
 import time
 
+LOG_FILE = 'log.txt'
+
+# names of rotation periods (rotate_when) and their part of file name
+_PERIODS = {'H': '%Y-%m-%d_%H', 'D': '%Y-%m-%d', 'MIDNIGHT': '%Y-%m-%d'}
+
+# fields added to every record, e.g. user and version
+context = {}
+
+_logger = logging.getLogger('repairs')
+_logger.propagate = False
+_lock = threading.RLock()
+_listener = None
+
+
+class _Formatter(logging.Formatter):
+    """ 'time LEVEL message [field=value ...]' and traceback if any. """
+    def format(self, record):
+        fields = getattr(record, 'fields', {})
+        record.fields_text = (' [' + ' '.join(
+            '{}={}'.format(key, value) for key, value in fields.items())
+            + ']') if fields else ''
+        return super().format(record)
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record):
+        """ Message and traceback are formatted in the calling thread,
+            the rest is done by writer thread.
+        """
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class _SharedFileHandler(logging.FileHandler):
+    """ Log file written by several processes at once (app is started
+        by many users from the same folder).
+
+    Files are never renamed, since it fails on Windows while file is
+    open by other process. Records go to log[.period][.part].txt, the next
+    part is started when file exceeds max_bytes, the oldest files beyond
+    backup_count are deleted.
+    """
+    def __init__(self, fname, max_bytes, backup_count, when=None):
+        if when is not None and when.upper() not in _PERIODS:
+            raise ValueError('Invalid rotation interval: ' + when)
+        self.base, self.ext = path.splitext(path.abspath(fname))
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.period_format = when and _PERIODS[when.upper()]
+        self.period = self._period()
+        super().__init__(self._fname(0), encoding='utf-8', delay=True)
+        try:
+            self._switch()
+        except OSError:
+            pass  # folder is unavailable, error is reported on write
+
+    def _period(self):
+        return self.period_format and time.strftime(self.period_format)
+
+    def _fname(self, part):
+        fname = self.base
+        if self.period:
+            fname += '.' + self.period
+        if part:
+            fname += '.{}'.format(part)
+        return fname + self.ext
 
-def writelog(e):
-    """ Write error log into file log.txt.
+    def _files(self, period_only=False):
+        """ Returns list of (part, fname) of log files, of the current
+            period only or of all periods.
+        """
+        prefix = path.basename(self.base)
+        if period_only:
+            if self.period:
+                prefix += '.' + self.period
+            suffix = r'(?:\.(\d+))?'
+        else:
+            suffix = r'(?:\.[\d_-]+)*'
+        pattern = re.compile(re.escape(prefix) + suffix
+                             + re.escape(self.ext) + '$')
+        directory = path.dirname(self.base)
+        files = []
+        for name in os.listdir(directory):
+            match = pattern.match(name)
+            if match:
+                part = int(match.group(1) or 0) if period_only else 0
+                files.append((part, path.join(directory, name)))
+        return files
+
+    def _is_full(self):
+        try:
+            return (self.max_bytes > 0
+                    and path.getsize(self.baseFilename) >= self.max_bytes)
+        except OSError:
+            return False
+
+    def _switch(self):
+        """ Continue the latest part of current period (other processes
+            may have started it) or start a new one.
+        """
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        part = max(self._files(period_only=True), default=(0, None))[0]
+        self.baseFilename = self._fname(part)
+        if self._is_full():
+            self.baseFilename = self._fname(part + 1)
+        # files are deleted if they aren't open by other processes
+        files = sorted(self._files(), key=lambda file: path.getmtime(file[1]))
+        for _, fname in files[:-(self.backup_count + 1)]:
+            if fname != self.baseFilename:
+                try:
+                    os.remove(fname)
+                except OSError:
+                    pass
+
+    def emit(self, record):
+        try:
+            period = self._period()
+            if period != self.period or self._is_full():
+                self.period = period
+                self._switch()
+        except OSError:
+            pass  # record is written into current file
+        super().emit(record)
+
+
+def configure(*, level='ERROR', fname=None, max_bytes=1024 * 1024,
+              backup_count=5, rotate_when=None):
+    """ (Re)start background writer.
+
+        level - str or int, records with lower level are dropped;
+        fname - str, log file, log.txt in working directory by default;
+        max_bytes - int, size of file to start the next one;
+        backup_count - int, number of previous files to keep;
+        rotate_when - str or None, if set ('H', 'D' or 'midnight') - new
+            file is started every hour or day too.
+        File may be shared by several processes (see _SharedFileHandler).
     """
-    fname = path.join(getcwd(), 'log.txt')
-    now = time.localtime()
+    global _listener
+    fname = fname or path.join(getcwd(), LOG_FILE)
+    handler = _SharedFileHandler(fname, max_bytes, backup_count,
+                                 when=rotate_when)
+    handler.setFormatter(_Formatter(
+        '%(asctime)s %(levelname)s %(message)s%(fields_text)s',
+        datefmt='%d-%m-%Y %H:%M:%S'))
+    records = queue.Queue()
+    with _lock:
+        shutdown()
+        _logger.setLevel(level.upper() if isinstance(level, str) else level)
+        for old in _logger.handlers[:]:
+            _logger.removeHandler(old)
+        _logger.addHandler(_QueueHandler(records))
+        _listener = QueueListener(records, handler)
+        _listener.start()
+
+
+def shutdown():
+    """ Write queued records and stop background writer. """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
 
-    with open(fname, 'a') as f:
-        f.write('{} {}\n'.format(time.strftime("%d-%m-%Y %H:%M:%S", now), e))
+
+def writelog(e, *, level=logging.ERROR, action=None, duration=None,
+             **fields):
+    """ Write error (exception or message) into log file.
+
+        level - int or str (e.g. 'WARNING');
+        action - str, what was being done;
+        duration - float, seconds the action took;
+        fields - any additional fields.
+        Exception type and traceback are added for exceptions.
+    """
+    if _listener is None:
+        with _lock:
+            if _listener is None:
+                configure()  # defaults until app configures log
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+    fields = dict(context, action=action, duration=duration, **fields)
+    exc_info = None
+    if isinstance(e, BaseException):
+        fields['type'] = type(e).__name__
+        if e.__traceback__ is not None:
+            exc_info = (type(e), e, e.__traceback__)
+    _logger.log(level, '%s', e, exc_info=exc_info,
+                extra={'fields': {key: value for key, value in fields.items()
+                                  if value is not None}})
+
+
+atexit.register(shutdown)
 
 
 if __name__ == '__main__':
+    context.update(user='test', version='0.0')
     try:
         1 / 0
     except ZeroDivisionError as e:
-        writelog(e)
+        writelog(e, action='division', duration=0.01)
+    # dropped with default level
+    writelog('Warning without traceback', level=logging.WARNING)
+
+    # two processes share files, the oldest ones are deleted
+    from tempfile import mkdtemp
+
+    directory = mkdtemp()
+    fname = path.join(directory, LOG_FILE)
+    handlers = [_SharedFileHandler(fname, max_bytes=100, backup_count=2,
+                                   when='midnight') for _ in range(2)]
+    for i in range(20):
+        handlers[i % 2].emit(logging.makeLogRecord({'msg': 'x' * 60}))
+    for handler in handlers:
+        handler.close()
+    names = sorted(os.listdir(directory))
+    assert len(names) == 3 and all(name.startswith('log.' + time.strftime(
+        '%Y-%m-%d')) for name in names), names
+    print('Shared log works:', names)
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Feb 14 11:37:52 2020
+
+@author: v.shkaberda
+
+Owner, RC and store of technics on any date found locally in history of
+its movements, which is loaded once per serial number.
+"""
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import date, datetime
+from time import monotonic
+import threading
+
+
+def _as_datetime(value):
+    """ date and datetime are compared as datetime (date is midnight). """
+    if isinstance(value, datetime):
+        return value
+    return datetime(value.year, value.month, value.day)
+
+
+class OwnerHistory(object):
+    """ Owner history of one technics split into intervals.
+
+    rows - rows (date_from, date_to, owner, rc, store) as returned by
+        DBConnect.get_object_owner_history, date_to is None for the current
+        owner. Row is valid for date_from <= date < date_to.
+    Dates of all rows split time into intervals, each interval keeps
+    (owner, rc, store) of rows covering it in order of rows, so lookup
+    returns the same rows as technics.get_object_owner_info.
+    """
+    __slots__ = ('_starts', '_objects')
+
+    def __init__(self, rows):
+        rows = [(_as_datetime(row[0]),
+                 None if row[1] is None else _as_datetime(row[1]),
+                 tuple(row[2:5])) for row in rows]
+        self._starts = sorted({bound for date_from, date_to, _ in rows
+                               for bound in (date_from, date_to)
+                               if bound is not None})
+        self._objects = [
+            [objects for date_from, date_to, objects in rows
+             if date_from <= start and (date_to is None or start < date_to)]
+            for start in self._starts]
+
+    def __len__(self):
+        return len(self._starts)
+
+    def lookup(self, date_broken):
+        """ Returns list of (owner, rc, store) on date_broken. """
+        i = bisect_right(self._starts, _as_datetime(date_broken)) - 1
+        return [] if i < 0 else list(self._objects[i])
+
+    def bounds(self):
+        """ Dates where owner may change (for consistency check). """
+        return list(self._starts)
+
+
+class OwnerHistoryCache(object):
+    """ Thread-safe LRU cache of OwnerHistory by serial number, shared
+        by all forms.
+
+    fetch - function (SN) returning history rows or None if they can't be
+        loaded (see DBConnect.get_object_owner_history), may be called
+        in worker thread;
+    executor - concurrent.futures executor for prefetch or None (history
+        is loaded when it's requested);
+    maxsize - int, number of serial numbers kept;
+    max_age - int, seconds after which history is loaded again (technics
+        may have been moved);
+    retry_after - int, seconds after failed loading (e.g. network error or
+        procedure is missing on server) while history isn't requested
+        and lookups return None at once.
+    """
+    def __init__(self, fetch, executor=None, maxsize=200, max_age=600,
+                 retry_after=60):
+        self.fetch = fetch
+        self.executor = executor
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # {SN: (loaded_at, future)}
+        self._failed_at = None  # time of the latest failed loading
+
+    def _load(self, sn):
+        rows = self.fetch(sn)
+        return None if rows is None else OwnerHistory(rows)
+
+    def _future(self, sn, background):
+        """ Returns future of history, loading is started if needed
+            (in the calling thread unless background is True).
+            Returns None while loading isn't retried after failure.
+        """
+        with self._lock:
+            if (self._failed_at is not None
+                    and monotonic() - self._failed_at < self.retry_after):
+                return None
+            entry = self._entries.get(sn)
+            if entry is not None and monotonic() - entry[0] <= self.max_age:
+                self._entries.move_to_end(sn)
+                return entry[1]
+            background = background and self.executor is not None
+            if background:
+                future = self.executor.submit(self._load, sn)
+            else:
+                future = Future()
+            self._entries[sn] = (monotonic(), future)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        if not background:
+            try:
+                future.set_result(self._load(sn))
+            except Exception as e:
+                future.set_exception(e)
+        return future
+
+    def prefetch(self, sn):
+        """ Start loading history of sn in background. """
+        self._future(sn, background=True)
+
+    def get(self, sn):
+        """ Returns OwnerHistory or None if it can't be loaded. """
+        future = self._future(sn, background=False)
+        if future is None:
+            return None
+        try:
+            history = future.result()
+        except Exception:
+            history = None
+        if history is None:
+            # history of sn is loaded again after retry_after
+            with self._lock:
+                self._failed_at = monotonic()
+                self._entries.pop(sn, None)
+        return history
+
+    def lookup(self, sn, date_broken):
+        """ Returns list of (owner, rc, store) of sn on date_broken or None
+            if history can't be loaded.
+        """
+        history = self.get(sn)
+        return None if history is None else history.lookup(date_broken)
+
+    def invalidate(self, sn=None):
+        """ Drop history of sn (of all serial numbers and failure state
+            if sn is None).
+        """
+        with self._lock:
+            if sn is None:
+                self._entries.clear()
+                self._failed_at = None
+            else:
+                self._entries.pop(sn, None)
+
+
+def compare(sql, sn, days=1):
+    """ Compare local lookup with technics.get_object_owner_info on every
+        date where owner changes and days around it.
+        Returns list of (date, expected, found) that differ.
+    """
+    from datetime import timedelta
+
+    history = OwnerHistory(sql.get_object_owner_history(sn))
+    dates = sorted({bound + timedelta(days=shift)
+                    for bound in history.bounds()
+                    for shift in range(-days, days + 1)})
+    differences = []
+    for dat in dates:
+        expected = [tuple(row) for row in sql.get_object_owner_info(sn, dat)]
+        found = history.lookup(dat)
+        if expected != found:
+            differences.append((dat, expected, found))
+    return differences
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) > 3:
+        # check against server: owner_history.py server db SN [SN ...]
+        from db_connect import DBConnect
+
+        with DBConnect(server=sys.argv[1], db=sys.argv[2]) as sql:
+            for sn in sys.argv[3:]:
+                differences = compare(sql, sn)
+                print(sn, 'OK' if not differences else differences)
+        sys.exit()
+
+    # lookup on fixed history: date_to isn't included, overlapping rows
+    # are returned in order of rows
+    from datetime import timedelta
+
+    a1, b2, a3 = ('A', 'РЦ1', 'С1'), ('B', 'РЦ2', 'С2'), ('A', 'РЦ3', 'С3')
+    history = OwnerHistory([(date(2019, 1, 1), date(2019, 3, 1), *a1),
+                            (datetime(2019, 3, 1), None, *b2),
+                            (date(2019, 2, 1), date(2019, 4, 1), *a3)])
+    expected = {date(2018, 12, 31): [],
+                date(2019, 1, 1): [a1],
+                date(2019, 2, 1): [a1, a3],
+                datetime(2019, 2, 28, 23, 59): [a1, a3],
+                date(2019, 3, 1): [b2, a3],
+                date(2019, 4, 1): [b2],
+                date(2030, 1, 1): [b2]}
+    for dat, objects in expected.items():
+        assert history.lookup(dat) == objects, (dat, history.lookup(dat))
+    assert len(history) == 4
+
+    # self-check against linear scan of rows
+    from random import randint, seed
+
+    seed(0)
+    start = date(2019, 1, 1)
+    rows = []
+    for i in range(30):
+        date_from = start + timedelta(days=randint(0, 400))
+        date_to = (None if i % 7 == 0
+                   else date_from + timedelta(days=randint(1, 60)))
+        rows.append((date_from, date_to, 'Владелец', 'РЦ{}'.format(i),
+                     'Склад'))
+    history = OwnerHistory(rows)
+
+    def scan(dat):
+        return [tuple(row[2:]) for row in rows if row[0] <= dat
+                and (row[1] is None or dat < row[1])]
+
+    for day in range(-10, 500):
+        dat = start + timedelta(days=day)
+        assert history.lookup(dat) == scan(dat), dat
+        assert history.lookup(_as_datetime(dat)) == scan(dat), dat
+
+    calls = []
+    cache = OwnerHistoryCache(lambda sn: calls.append(sn) or rows, maxsize=2)
+    for sn in ('SN1', 'SN1', 'SN2', 'SN3', 'SN1'):
+        cache.lookup(sn, date(2019, 6, 1))
+    assert calls == ['SN1', 'SN2', 'SN3', 'SN1'], calls
+    # failure isn't requested again until retry_after
+    failed = OwnerHistoryCache(lambda sn: calls.append(sn) or None)
+    assert failed.lookup('SN4', start) is None
+    assert failed.lookup('SN5', start) is None and calls[-1] == 'SN4'
+    assert 'SN5' not in calls
+    failed.retry_after = 0
+    assert failed.lookup('SN4', start) is None and calls[-2:] == ['SN4'] * 2
+    print('Owner history works.')
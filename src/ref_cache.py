@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Jan 20 09:41:26 2020
+
+@author: v.shkaberda
+"""
+from datetime import date, datetime
+from decimal import Decimal
+from log_error import writelog
+from time import monotonic
+import json
+import os
+import zlib
+
+# file header, change it if format of file is changed
+MAGIC = b'RPRC2'
+
+
+def default_directory():
+    """ Per-user directory for cache, so files can't be changed
+        by other users of shared install.
+    """
+    base = (os.environ.get('LOCALAPPDATA')
+            or os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'Repairs', 'cache')
+
+
+def _encode(value):
+    """ Values of db types not supported by json. """
+    if isinstance(value, Decimal):
+        return {'$decimal': str(value)}
+    if isinstance(value, datetime):
+        return {'$datetime': value.isoformat()}
+    if isinstance(value, date):
+        return {'$date': value.isoformat()}
+    if isinstance(value, (bytes, bytearray)):
+        return {'$bytes': value.hex()}
+    raise TypeError('Unsupported type: {}'.format(type(value).__name__))
+
+
+def _decode(obj):
+    if len(obj) == 1:
+        (key, value), = obj.items()
+        if key == '$decimal':
+            return Decimal(value)
+        if key == '$datetime':
+            return datetime.fromisoformat(value)
+        if key == '$date':
+            return date.fromisoformat(value)
+        if key == '$bytes':
+            return bytes.fromhex(value)
+    return obj
+
+
+def _freeze(value):
+    """ json arrays are read as lists, rows and tokens were tuples. """
+    if isinstance(value, list):
+        return tuple(map(_freeze, value))
+    return value
+
+
+class ReferenceCache(object):
+    """ On-disk cache of reference sets, one compressed file per set.
+
+    Every file stores version token of the set given by server,
+    rows are used only while server reports the same version.
+    Files are json (not pickle), so reading them can't run code.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + '.cache')
+
+    def get(self, name, version, fetch):
+        """ Returns cached rows of reference set if version matches,
+            otherwise calls fetch() and stores its result.
+
+            version: version token of the set on server or None
+                if it's unknown (cache isn't used).
+        """
+        if version is not None:
+            rows = self.load(name, version)
+            if rows is not None:
+                return rows
+        rows = fetch()
+        if version is not None and rows is not None:
+            self.save(name, version, rows)
+        return rows
+
+    def has(self, name):
+        """ Check if reference set has been cached. """
+        return os.path.isfile(self._path(name))
+
+    def load(self, name, version):
+        """ Returns rows or None if cache is missing, outdated or corrupted.
+        """
+        try:
+            with open(self._path(name), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if not data.startswith(MAGIC):
+            return None
+        try:
+            cached_version, rows = json.loads(
+                zlib.decompress(data[len(MAGIC):]).decode('utf-8'),
+                object_hook=_decode)
+            cached_version = _freeze(cached_version)
+            rows = [_freeze(row) for row in rows]
+        except Exception as e:
+            writelog('Corrupted cache {}: {!r}'.format(name, e))
+            return None
+        if cached_version != version:
+            return None
+        return rows
+
+    def save(self, name, version, rows):
+        """ Store rows of reference set, file is replaced atomically. """
+        path = self._path(name)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            data = zlib.compress(json.dumps(
+                (version, [tuple(row) for row in rows]), default=_encode,
+                ensure_ascii=False).encode('utf-8'))
+            with open(path + '.tmp', 'wb') as f:
+                f.write(MAGIC + data)
+            os.replace(path + '.tmp', path)
+        except (OSError, TypeError) as e:
+            writelog('Unable to save cache {}: {!r}'.format(name, e))
+
+
+class ExpiringValue(object):
+    """ In-process value with time to live.
+
+    The first get() loads value synchronously (unless ready() is checked
+    before). Expired value is still returned, but reload is started in
+    background (stale-while-revalidate) and its result is used by the next
+    get().
+
+    fetch - callable without arguments, returns value;
+    ttl - int, seconds while value is considered fresh;
+    executor - concurrent.futures executor for background reload.
+    """
+    def __init__(self, fetch, ttl, executor):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.executor = executor
+        self.value = None
+        self.loaded_at = None
+        self._future = None
+
+    def _collect(self, wait=False):
+        """ Take result of background reload if it's ready. """
+        if self._future is None or not (wait or self._future.done()):
+            return
+        future, self._future = self._future, None
+        try:
+            self._set(future.result())
+        except Exception as e:
+            # keep stale value, the next get() will try again
+            writelog(e)
+            if wait:
+                raise
+
+    def _set(self, value):
+        self.value = value
+        self.loaded_at = monotonic()
+
+    def get(self):
+        self._collect(wait=self.value is None)
+        if self.value is None:
+            self._set(self.fetch())
+        elif monotonic() - self.loaded_at > self.ttl:
+            self.prefetch()
+        return self.value
+
+    def invalidate(self):
+        """ Drop value and start loading a new one. Reload started before
+            is discarded, since it may return value read before the change.
+        """
+        self.value = None
+        if self._future is not None:
+            self._future.cancel()
+            self._future = None
+        self.prefetch()
+
+    def ready(self):
+        """ True if get() returns without waiting for loading, otherwise
+            loading is started in background.
+        """
+        if self.value is None and self._future is None:
+            self.prefetch()
+        return self.value is not None or self._future.done()
+
+    def prefetch(self):
+        """ Start background reload if it isn't running. """
+        if self._future is None:
+            self._future = self.executor.submit(self.fetch)
+
+
+if __name__ == '__main__':
+    from tempfile import mkdtemp
+
+    cache = ReferenceCache(mkdtemp())
+    calls = []
+    fetch = lambda: calls.append(1) or [(1, 'a'), (2, 'b')]
+    assert cache.get('refs', 'v1', fetch) == [(1, 'a'), (2, 'b')]
+    assert cache.get('refs', 'v1', fetch) == [(1, 'a'), (2, 'b')]
+    assert len(calls) == 1, 'Cache is not used.'
+    cache.get('refs', 'v2', fetch)
+    assert len(calls) == 2, 'Outdated cache is used.'
+    with open(cache._path('refs'), 'wb') as f:
+        f.write(MAGIC + b'garbage')
+    cache.get('refs', 'v2', fetch)
+    assert len(calls) == 3, 'Corrupted cache is used.'
+    typed = [(Decimal('1.50'), date(2020, 1, 2), datetime(2020, 1, 2, 3),
+              b'\x00\x01', None, 'Склад')]
+    cache.get('typed', (b'\x00\x07', 1), lambda: typed)
+    assert cache.load('typed', (b'\x00\x07', 1)) == typed, 'Types lost.'
+    print('Cache works.')
+
+    from concurrent.futures import ThreadPoolExecutor
+    from time import sleep
+    import threading
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        value = ExpiringValue(lambda: calls.append(1) or len(calls),
+                              ttl=0.1, executor=executor)
+        assert value.get() == 4
+        assert value.get() == 4, 'Fresh value is reloaded.'
+        sleep(0.2)
+        assert value.get() == 4, 'Stale value is not returned.'
+        executor.submit(lambda: None).result()  # wait for reload
+        assert value.get() == 5, 'Value is not revalidated.'
+
+        server = ['old']
+        started, release = threading.Event(), threading.Event()
+
+        def slow_fetch():
+            result = server[0]
+            started.set()
+            release.wait()
+            return result
+
+        value = ExpiringValue(slow_fetch, ttl=0.1, executor=executor)
+        value.prefetch()
+        started.wait()
+        server[0] = 'new'  # changed while reload is running
+        value.invalidate()
+        release.set()
+        assert value.get() == 'new', 'Reload started before invalidate used.'
+
+        value = ExpiringValue(slow_fetch, ttl=0.1, executor=executor)
+        started.clear()
+        release.clear()
+        assert not value.ready(), 'Value is ready before loading.'
+        started.wait()
+        release.set()
+        executor.submit(lambda: None).result()  # wait for loading
+        assert value.ready() and value.get() == 'new'
+    print('Expiring value works.')
@@ -4,14 +4,21 @@ Created on Thu Nov 21 17:28:04 2019
 
 @author: v.shkaberda
 """
-from _version import version_info
-from collections import defaultdict, namedtuple
+from startup_trace import StartupTrace
+TRACE = StartupTrace()  # started before other imports to measure them
+
+from _version import __version__, version_info
+from collections import defaultdict
 from db_connect import DBConnect
+from log_error import configure as configure_log, context as log_context
 from log_error import writelog
 from pyodbc import Error as SQLError
+from ref_cache import default_directory, ReferenceCache
 import sys
 import tkRepairs as tkr
 
+TRACE.mark('import')
+TRACE.info['version'] = __version__
 
 def main():
     # Reading config and setting parameters
@@ -27,53 +34,121 @@ def main():
 
     except ValueError:
         writelog('Error: config.ini have unappropriate lines: ' + line)
+        TRACE.outcome = 'config_error'
         sys.exit(1)
+    configure_log(level=config.get('log_level', 'ERROR'),
+                  max_bytes=int(config.get('log_max_bytes', 1024 * 1024)),
+                  backup_count=int(config.get('log_backup_count', 5)),
+                  rotate_when=config.get('log_rotate_when'))
+    log_context['version'] = __version__
+    TRACE.mark('config')
 
     conn = DBConnect(server=config['server'],
-                     db=config['db'])
-    UserInfo = namedtuple('UserInfo', ['UserID', 'ShortUserName',
-                                       'AccessType', 'isSuperUser'])
+                     db=config['db'],
+                     pool_size=int(config.get('pool_size', 4)),
+                     idle_timeout=int(config.get('pool_idle_timeout', 300)),
+                     retries=int(config.get('retries', 2)),
+                     reset_timeout=int(config.get('offline_check_after', 30)),
+                     idempotency_keys=bool(int(config.get('idempotency_keys',
+                                                          0))))
+    # app registers its own handler when it starts
+    conn.on_network_error = lambda e: tkr.NetworkError()
     refs = defaultdict(dict)
+    ref_cache = ReferenceCache(config.get('cache_dir') or default_directory())
     try:
         with conn as sql:
-            if sql.get_version_for_comparison() != version_info[:2]:
+            TRACE.mark('connect')
+            # if references are cached, only their version is requested
+            cached = ref_cache.has('references')
+            try:
+                boot = sql.bootstrap(with_references=not cached,
+                                     with_versions=True)
+            except SQLError as e:
+                # server is reachable, but startup data can't be read
+                # (e.g. procedure is missing or its execution is denied)
+                writelog(e, action='bootstrap')
+                TRACE.outcome = 'bootstrap_error'
+                tkr.UnexpectedError(e)
+                return
+            if boot is None:
+                # network error has been shown
+                TRACE.outcome = 'network_error'
+                return
+
+            if boot.version != version_info[:2]:
                 raise tkr.UpdateRequiredError(version_info[:2])
 
-            access_permitted = sql.access_check()
-            if not access_permitted:
+            if not boot.access_permitted:
+                TRACE.outcome = 'access_denied'
                 tkr.AccessError()
                 sys.exit()
 
+            TRACE.mark('version_access_check')
+
             # load references
-            user_info = UserInfo(*sql.get_user_info())
-            for ref_type, ref_id, ref_name in sql.get_references():
+            user_info = boot.user_info
+            TRACE.info['user'] = user_info.ShortUserName
+            conn.metrics.info.update(TRACE.info)
+            log_context['user'] = user_info.ShortUserName
+            version = boot.references_versions.get('references')
+            if boot.references is not None:
+                references = boot.references
+                if version is not None:
+                    ref_cache.save('references', version, references)
+            else:
+                references = ref_cache.get('references', version,
+                                           sql.get_references)
+            for ref_type, ref_id, ref_name in references:
                 refs[ref_type][ref_name] = ref_id
+            TRACE.mark('references')
 
         # Run app
         root = tkr.RepairTk()
         app = tkr.RepairApp(root=root,
                             connection=conn,
                             user_info=user_info,
-                            references=refs
+                            references=refs,
+                            ref_cache=ref_cache,
+                            refs_ttl=int(config.get('refs_ttl', 600)),
+                            page_size=int(config.get('page_size', 0)),
+                            filter_max_age=int(config.get('filter_max_age', 0)),
+                            trace=TRACE,
+                            columnar=bool(int(config.get('columnar_rows', 0))),
+                            stream_batch=int(config.get('stream_batch', 0)),
+                            row_max_age=int(config.get('row_max_age', 60)),
+                            replica_file=config.get('replica_file')
                             )
+        # trace is written by app when the first rows are shown
+        TRACE.outcome = 'closed'
         app.run()
 
     except SQLError as e:
         # login failed
         if e.args[0] in ('28000', '42000'):
+            TRACE.outcome = 'login_failed'
             tkr.LoginError()
         else:
             raise
 
     except tkr.UpdateRequiredError as e:
-        writelog(e)
+        writelog(e, action='version_check')
+        TRACE.outcome = 'update_required'
         tkr.ReinstallRequiredError()
 
+    finally:
+        conn.close()
+
 
 if __name__ == '__main__':
     try:
         main()
     except Exception as e:
-        writelog(e)
+        TRACE.outcome = 'error'
+        writelog(e, level='CRITICAL', action='main')
     finally:
+        # aborted launch is traced too (with its outcome)
+        try:
+            TRACE.write()
+        except OSError as e:
+            writelog(e)
         sys.exit()
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Feb 13 10:21:44 2020
+
+@author: v.shkaberda
+
+Export of repair list into CSV/XLSX file. Rows are written batch by batch
+as they are fetched from server, so memory doesn't depend on their number.
+"""
+from datetime import date, datetime
+from decimal import Decimal
+import csv
+import os
+
+
+class RepairExportError(Exception):
+    """ Exception raised if file can't be written.
+
+    Attributes:
+        message - explanation of the error.
+    """
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+class ExportReport(object):
+    """ Progress and result of export, may be read by other thread
+        while export is running.
+
+    rows - number of written rows;
+    done - True if all rows have been written and file is saved;
+    cancelled - True if export was stopped by user;
+    error - str or None, reason export was aborted.
+    """
+    def __init__(self):
+        self.rows = 0
+        self.done = False
+        self.cancelled = False
+        self.error = None
+
+    def summary(self):
+        if self.done:
+            return 'Выгружено строк: {}'.format(self.rows)
+        if self.cancelled:
+            return 'Выгрузка прервана пользователем'
+        return 'Выгрузка остановлена: ' + (self.error or 'неизвестная ошибка')
+
+
+def _csv_value(value):
+    """ Value as Excel with russian locale reads it. """
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.strftime('%d.%m.%Y %H:%M:%S')
+    if isinstance(value, date):
+        return value.strftime('%d.%m.%Y')
+    if isinstance(value, (float, Decimal)):
+        return str(value).replace('.', ',')
+    return value
+
+
+class _CSVWriter(object):
+    def __init__(self, fname):
+        self.file = open(fname, 'w', newline='', encoding='utf-8-sig')
+        self.writer = csv.writer(self.file, delimiter=';')
+
+    def write_rows(self, rows):
+        self.writer.writerows([_csv_value(value) for value in row]
+                              for row in rows)
+
+    def close(self):
+        self.file.close()
+
+
+class _XLSXWriter(object):
+    """ Write-only workbook keeps only the current row in memory. """
+    def __init__(self, fname):
+        try:
+            from openpyxl import Workbook
+        except ImportError:
+            raise RepairExportError('Для выгрузки в XLSX требуется '
+                                    'пакет openpyxl')
+        self.fname = fname
+        self.workbook = Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet('Ремонты')
+
+    def write_rows(self, rows):
+        for row in rows:
+            # Decimal is written as number
+            self.sheet.append([float(value) if isinstance(value, Decimal)
+                               else value for value in row])
+
+    def close(self):
+        # workbook is written to file here (rows are kept in temp file)
+        self.workbook.save(self.fname)
+
+
+def export_rows(batches, fname, headings, report=None, cancel=None):
+    """ Write rows into CSV or XLSX file (by extension of fname).
+        May run in worker thread.
+
+        batches - iterable of lists of rows, e.g. DBConnect.iter_repair_list;
+        headings - sequence of column captions written as the first row;
+        report - ExportReport to be filled (it can be watched by caller);
+        cancel - threading.Event or None, if it is set export stops
+            before the next batch.
+        File is written under temporary name and replaces fname only
+        if all rows have been written.
+        Returns ExportReport.
+    """
+    report = report or ExportReport()
+    ext = os.path.splitext(fname)[1].lower()
+    if ext not in ('.csv', '.xlsx'):
+        report.error = 'неподдерживаемый формат файла: ' + ext
+        return report
+    tmp_fname = '{}.{}.tmp{}'.format(fname, os.getpid(), ext)
+    try:
+        writer = (_CSVWriter if ext == '.csv' else _XLSXWriter)(tmp_fname)
+    except RepairExportError as e:
+        report.error = e.message
+        return report
+    closed = False
+    try:
+        writer.write_rows((headings,))
+        for rows in batches:
+            if cancel is not None and cancel.is_set():
+                report.cancelled = True
+                break
+            writer.write_rows(rows)
+            report.rows += len(rows)
+        closed = True
+        writer.close()
+        if not report.cancelled:
+            os.replace(tmp_fname, fname)
+            report.done = True
+    finally:
+        if not report.done:
+            if not closed:
+                writer.close()
+            try:
+                os.remove(tmp_fname)
+            except OSError:
+                pass
+    return report
+
+
+if __name__ == '__main__':
+    from random import choice, random
+    from tempfile import mkdtemp
+    import threading
+    import tracemalloc
+
+    def batches(n, size=1000):
+        """ Rows similar to repair list generated batch by batch. """
+        for start in range(0, n, size):
+            yield [(i, 'Иванов И.И.', datetime(2020, 1, 1, 12, 0), 1,
+                    choice(('Новый', 'В работе')), 'РЦ', 'Склад', None,
+                    'Собственник', 'Погрузчик', 'Производитель', 'Модель',
+                    'SN{}'.format(i), Decimal('1234.5'), date(2020, 1, 2),
+                    None, 'Описание' * 5, 'Работы' * 5, random(), 'шт')
+                   for i in range(start, min(n, start + size))]
+
+    headings = ['column{}'.format(i) for i in range(20)]
+    fname = os.path.join(mkdtemp(), 'repairs.csv')
+    tracemalloc.start()
+    report = export_rows(batches(100000), fname, headings)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    # peak doesn't grow with number of rows (one batch is kept in memory)
+    print('{}, file {} MB, peak memory {:.1f} MB'.format(
+        report.summary(), os.path.getsize(fname) // 2**20, peak / 2**20))
+    cancel = threading.Event()
+    cancel.set()
+    report = export_rows(batches(10), fname + '2.csv', headings,
+                         cancel=cancel)
+    assert report.cancelled and not os.listdir(os.path.dirname(fname))[1:]
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Jan 16 11:03:47 2020
+
+@author: v.shkaberda
+"""
+from itertools import compress
+from time import monotonic
+
+
+class RepairFilter(object):
+    """ Client-side filter over once loaded repair list.
+
+    For every filtered column an inverted index {value: bitset} is built
+    on the first use, bit i of bitset is set if rows[i] has this value.
+    Any combination of filters is resolved by AND of bitsets.
+
+    rows - sequence of rows (all repairs without filters);
+    columns - sequence of column names in the order of row values.
+    """
+    def __init__(self, rows, columns):
+        self.rows = rows
+        self.columns = {col: i for i, col in enumerate(columns)}
+        self.loaded_at = monotonic()
+        self._indexes = {}
+
+    def _index(self, column):
+        """ Returns {value: bitset} for column, builds it if needed. """
+        try:
+            return self._indexes[column]
+        except KeyError:
+            pass
+        col = self.columns[column]
+        positions = {}
+        if hasattr(self.rows, 'column'):  # columnar storage
+            values = self.rows.column(col)
+        else:
+            values = [row[col] for row in self.rows]
+        for i, value in enumerate(values):
+            positions.setdefault(value, []).append(i)
+        index = {}
+        size = len(self.rows) // 8 + 1
+        for value, rows_i in positions.items():
+            bits = bytearray(size)
+            for i in rows_i:
+                bits[i >> 3] |= 1 << (i & 7)
+            index[value] = int.from_bytes(bits, 'little')
+        self._indexes[column] = index
+        return index
+
+    def values(self, column):
+        """ Returns set of values of column. """
+        return set(self._index(column))
+
+    def age(self):
+        """ Seconds since rows were loaded. """
+        return monotonic() - self.loaded_at
+
+    def is_stale(self, max_age):
+        return self.age() > max_age
+
+    def select(self, criteria):
+        """ Returns list of rows (in initial order) matching all criteria.
+            For columnar storage view of matching rows is returned.
+
+        criteria - dict {column name: value}.
+        """
+        columnar = hasattr(self.rows, 'view')
+        if not criteria:
+            return (self.rows.view(range(len(self.rows))) if columnar
+                    else list(self.rows))
+        bits = -1
+        for column, value in criteria.items():
+            bits &= self._index(column).get(value, 0)
+            if not bits:
+                return self.rows.view(()) if columnar else []
+        # bits as string from the lowest one
+        flags = map('1'.__eq__, bin(bits)[:1:-1])
+        if columnar:
+            return self.rows.view(compress(range(len(self.rows)), flags))
+        return list(compress(self.rows, flags))
+
+
+if __name__ == '__main__':
+    from random import choice, seed
+    from time import perf_counter
+
+    seed(0)
+    columns = ('ID', 'РЦ', 'Статус', 'Производитель')
+    rows = [(i, choice(('РЦ1', 'РЦ2', 'РЦ3')), choice(('Созд.', 'Фикс.')),
+             choice(('Toyota', 'Jungheinrich', 'Linde', 'Still')))
+            for i in range(200000)]
+    engine = RepairFilter(rows, columns)
+    start = perf_counter()
+    for col in columns[1:]:
+        engine._index(col)
+    print('Indexes built: {:.0f} ms'.format((perf_counter() - start) * 1000))
+    criteria = {'РЦ': 'РЦ2', 'Статус': 'Фикс.', 'Производитель': 'Linde'}
+    start = perf_counter()
+    selected = engine.select(criteria)
+    print('Selected {} rows: {:.1f} ms'.format(
+        len(selected), (perf_counter() - start) * 1000))
+    assert selected == [row for row in rows if row[1] == 'РЦ2'
+                        and row[2] == 'Фикс.' and row[3] == 'Linde']
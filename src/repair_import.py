@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Feb 12 09:47:30 2020
+
+@author: v.shkaberda
+
+Bulk import of repairs from CSV/XLSX file. File is read lazily row by row,
+rows are checked by the same rules as in creating form and valid ones are
+created by batches (one round trip and one transaction per batch).
+"""
+from datetime import date, datetime
+from db_connect import batch_request_key, MAX_BATCH
+from log_error import writelog
+from pyodbc import Error as SQLError
+from repair_rules import check_repair, convert_date, float_form
+import codecs
+import csv
+import os
+
+# column caption in file: field of repair
+COLUMNS = {'Серийный номер': 'SN',
+           'Наряд-заказ': 'OutfitOrder',
+           'Дата поломки': 'date_broken',
+           'Текущие моточасы': 'WorkingHours',
+           'Кол-во запчастей': 'NumberOfUnits',
+           'Единица измерения': 'UnitOfMeasure',
+           'Описание неисправности': 'FaultDescription',
+           'Проведённые работы': 'PerformedWork',
+           'Дата окончания ремонта': 'date_repair_finished'}
+REQUIRED = ('Серийный номер', 'Дата поломки')
+
+
+class RepairImportError(Exception):
+    """ Exception raised if file can't be imported at all.
+
+    Attributes:
+        message - explanation of the error.
+    """
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+class ImportReport(object):
+    """ Progress and result of import, may be read by other thread
+        while import is running.
+
+    total - number of processed rows;
+    created - number of created repairs;
+    errors - list of (line, SN, message) of rows that weren't created;
+    cancelled - True if import was stopped by user;
+    error - str or None, reason import was aborted.
+    """
+    def __init__(self):
+        self.total = 0
+        self.created = 0
+        self.errors = []
+        self.cancelled = False
+        self.error = None
+
+    def save(self, fname):
+        """ Write errors into csv file. """
+        with open(fname, 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.writer(f, delimiter=';')
+            writer.writerow(('Строка', 'Серийный номер', 'Ошибка'))
+            writer.writerows(self.errors)
+
+    def summary(self):
+        lines = ['Обработано строк: {}'.format(self.total),
+                 'Создано ремонтов: {}'.format(self.created),
+                 'Ошибок: {}'.format(len(self.errors))]
+        if self.cancelled:
+            lines.append('Импорт прерван пользователем')
+        if self.error:
+            lines.append('Импорт остановлен: ' + self.error)
+        return '\n'.join(lines)
+
+
+def _detect_encoding(fname):
+    """ utf-8 (with or without BOM) or cp1251 used by Excel. """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    with open(fname, 'rb') as f:
+        try:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                decoder.decode(chunk)
+            decoder.decode(b'', final=True)
+        except UnicodeDecodeError:
+            return 'cp1251'
+    return 'utf-8-sig'
+
+
+def _read_csv(fname):
+    with open(fname, newline='', encoding=_detect_encoding(fname)) as f:
+        sample = f.read(4096)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=';,\t')
+        except csv.Error:
+            dialect = None
+        if dialect is None:
+            # Excel with russian locale uses ';'
+            yield from csv.reader(f, delimiter=';')
+        else:
+            yield from csv.reader(f, dialect)
+
+
+def _read_xlsx(fname):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise RepairImportError('Для импорта XLSX требуется пакет openpyxl')
+    workbook = load_workbook(fname, read_only=True, data_only=True)
+    try:
+        yield from workbook.active.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def read_rows(fname):
+    """ Yields (line number, {column caption: value}) for every non-empty
+        row of CSV or XLSX file. The first row contains column captions.
+    """
+    ext = os.path.splitext(fname)[1].lower()
+    if ext == '.csv':
+        rows = _read_csv(fname)
+    elif ext == '.xlsx':
+        rows = _read_xlsx(fname)
+    else:
+        raise RepairImportError('Неподдерживаемый формат файла: ' + ext)
+    header = next(rows, None)
+    if header is None:
+        raise RepairImportError('Файл пуст')
+    header = [_text(caption) for caption in header]
+    missing = [caption for caption in REQUIRED if caption not in header]
+    if missing:
+        raise RepairImportError('Нет обязательных столбцов: '
+                                + ', '.join(missing))
+    for line, values in enumerate(rows, 2):
+        if any(_text(value) for value in values):
+            yield line, dict(zip(header, values))
+
+
+def _text(value):
+    """ Value of cell as it would be entered in form. """
+    if value is None:
+        return ''
+    if isinstance(value, (date, datetime)):
+        return value.strftime('%d.%m.%Y')
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+def validate_row(values, tech_info, measure_units, owner_info):
+    """ Returns (repair, None) if row is correct or (None, error message).
+
+        values - dict {column caption: value};
+        tech_info - dict {SN: info}, known technics;
+        measure_units - dict {name: UnitOfMeasureID};
+        owner_info - function (SN, date) returning rows (owner, rc, store)
+            of technics on date, see DBConnect.get_object_owner_info.
+    """
+    field = {name: _text(values.get(caption))
+             for caption, name in COLUMNS.items()}
+    if field['SN'] not in tech_info:
+        return None, 'Серийный номер не найден'
+    units = field['UnitOfMeasure']
+    if units and units not in measure_units:
+        return None, 'Неизвестная единица измерения: ' + units
+    # rc and store are known only after request to server,
+    # so other fields are checked first
+    check = lambda rc, store: check_repair(
+        workhours=field['WorkingHours'], number_units=field['NumberOfUnits'],
+        units_measure=units, rc=rc, store=store,
+        date_broken=field['date_broken'])
+    message = check(rc='-', store='-')
+    if message:
+        return None, message
+    date_broken = convert_date(field['date_broken'])
+    try:
+        date_repair_finished = (convert_date(field['date_repair_finished'])
+                                if field['date_repair_finished'] else None)
+    except ValueError:
+        return None, 'Дата окончания ремонта некорректна'
+    objects = owner_info(field['SN'], date_broken)
+    if not objects:
+        return None, 'В указанную дату техника не привязана ни к одному РЦ'
+    message = check(rc=objects[0][1], store=objects[0][2])
+    if message:
+        return None, message
+    workhours = float_form(field['WorkingHours'])
+    number_units = float_form(field['NumberOfUnits'])
+    return {
+        'SN': field['SN'],
+        'date_broken': date_broken,
+        'date_repair_finished': date_repair_finished,
+        'OutfitOrder': field['OutfitOrder'] or None,
+        'WorkingHours': float(workhours) if workhours else None,
+        'UnitOfMeasureID': measure_units[units] if units else None,
+        'NumberOfUnits': float(number_units) if number_units else None,
+        'FaultDescription': field['FaultDescription'] or None,
+        'PerformedWork': field['PerformedWork'] or None
+        }, None
+
+
+def _server_message(e):
+    """ Text of server error without driver prefixes. """
+    message = str(e.args[1] if len(e.args) > 1 else e)
+    return message[message.rfind(']') + 1:].split(' (')[0].strip()
+
+
+def _submit(sql, batch, report, userID, statusID, request_key):
+    """ Create repairs of batch [(line, repair)] by one request. If server
+        rejects batch, repairs are created one by one: rejected ones are
+        reported and import goes on. Import is stopped (RepairImportError)
+        only by network error, since it's unknown if repair is saved.
+    """
+    key = None if request_key is None else batch_request_key(request_key,
+                                                             batch[0][0])
+    try:
+        results = sql.create_repairs([repair for _, repair in batch],
+                                     userID=userID, statusID=statusID,
+                                     request_key=key)
+    except SQLError as e:
+        # server raised error, batch has been rolled back
+        writelog(e, level='WARNING', action='import')
+        results = [None]
+    if results is None:
+        # batch may be saved or not, so it isn't repeated
+        report.errors.extend((line, repair['SN'], 'Ошибка при обращении '
+                              'к серверу, проверьте наличие ремонта')
+                             for line, repair in batch)
+        raise RepairImportError('ошибка при обращении к серверу')
+    if all(result == 1 for result in results):
+        report.created += len(batch)
+        return
+    # batch has been rolled back, every repair is sent as batch of one
+    # to tell rejection (error or result) from network error
+    for i, (line, repair) in enumerate(batch):
+        try:
+            results = sql.create_repairs(
+                [repair], userID=userID, statusID=statusID,
+                request_key=None if key is None else batch_request_key(key,
+                                                                       i))
+        except SQLError as e:
+            report.errors.append((line, repair['SN'],
+                                  'Сервер отклонил создание ремонта: '
+                                  + _server_message(e)))
+            continue
+        if results is None:
+            report.errors.append((line, repair['SN'], 'Ошибка при обращении '
+                                  'к серверу, проверьте наличие ремонта'))
+            report.errors.extend((line, repair['SN'], 'Ремонт не создан, '
+                                  'импорт остановлен')
+                                 for line, repair in batch[i + 1:])
+            raise RepairImportError('ошибка при обращении к серверу')
+        if results[0] == 1:
+            report.created += 1
+        else:
+            report.errors.append((line, repair['SN'],
+                                  'Сервер отклонил создание ремонта'))
+
+
+def import_repairs(rows, conn, *, userID, statusID, tech_info,
+                   measure_units, batch_size=100, report=None, cancel=None,
+                   request_key=None):
+    """ Check rows and create valid repairs by batches.
+        May run in worker thread.
+
+        rows - iterable of (line number, values), see read_rows;
+        conn - DBConnect;
+        batch_size - int, number of repairs created by one request;
+        report - ImportReport to be filled (it can be watched by caller);
+        cancel - threading.Event or None, if it is set import stops before
+            the next row (not created rows of current batch are skipped);
+        request_key - str (uuid) or None, if given - requests are sent with
+            keys derived from it and line numbers (see DBConnect).
+        Returns ImportReport.
+    """
+    report = report or ImportReport()
+    batch_size = min(batch_size, MAX_BATCH)
+    owners = {}  # {(SN, date): rows}, the same technics is checked once
+    batch = []
+    try:
+        with conn as sql:
+            def owner_info(sn, date_broken):
+                if (sn, date_broken) not in owners:
+                    objects = sql.get_object_owner_info(sn, date_broken)
+                    if objects is None:
+                        raise RepairImportError('ошибка при обращении '
+                                                'к серверу')
+                    owners[sn, date_broken] = objects
+                return owners[sn, date_broken]
+
+            for line, values in rows:
+                if cancel is not None and cancel.is_set():
+                    report.cancelled = True
+                    report.errors.extend(
+                        (line, repair['SN'], 'Ремонт не создан, '
+                         'импорт прерван пользователем')
+                        for line, repair in batch)
+                    return report
+                repair, message = validate_row(values, tech_info,
+                                               measure_units, owner_info)
+                report.total += 1
+                if message:
+                    report.errors.append(
+                        (line, _text(values.get('Серийный номер')), message))
+                    continue
+                batch.append((line, repair))
+                if len(batch) >= batch_size:
+                    # rows of failed batch are reported by _submit
+                    pending, batch = batch, []
+                    _submit(sql, pending, report, userID, statusID,
+                            request_key)
+            if batch:
+                pending, batch = batch, []
+                _submit(sql, pending, report, userID, statusID, request_key)
+    except RepairImportError as e:
+        report.error = e.message
+        # import is stopped while checking rows
+        report.errors.extend((line, repair['SN'], 'Ремонт не создан, '
+                              'импорт остановлен')
+                             for line, repair in batch)
+    return report
+
+
+if __name__ == '__main__':
+    from tempfile import mkdtemp
+
+    fname = os.path.join(mkdtemp(), 'repairs.csv')
+    with open(fname, 'w', newline='', encoding='cp1251') as f:
+        writer = csv.writer(f, delimiter=';')
+        writer.writerow(('Серийный номер', 'Дата поломки', 'Текущие моточасы',
+                         'Кол-во запчастей', 'Единица измерения'))
+        writer.writerow(('SN1', '01.02.2020', '1 234,5', '2', 'шт'))
+        writer.writerow(('SN2', '01.02.2020', '', '', ''))
+        writer.writerow(('SN1', '31.02.2020', '', '', ''))
+        writer.writerow(('SN1', '01.02.2020', 'много', '', ''))
+        writer.writerow(('SN1', '01.02.2020', '', '3', ''))
+        writer.writerow(('SN1', '01.02.1999', '', '', ''))
+        writer.writerow(('', '', '', '', ''))
+    owner_info = lambda sn, dat: ([('Владелец', 'РЦ', 'Склад')]
+                                  if dat.year == 2020 else [])
+    for line, values in read_rows(fname):
+        repair, message = validate_row(values, {'SN1': ()}, {'шт': 1},
+                                       owner_info)
+        print(line, message or repair)
+
+    class FakeSQL(object):
+        """ Server rejects repairs of SN 'bad' by error and of SN 'zero'
+            by result, 'lost' is network error.
+        """
+        def create_repairs(self, repairs, **kwargs):
+            sns = [repair['SN'] for repair in repairs]
+            if 'bad' in sns:
+                raise SQLError('23000', '[SQL Server]Нарушение ограничения')
+            if 'lost' in sns:
+                return None
+            return [0 if sn == 'zero' else 1 for sn in sns]
+
+    report = ImportReport()
+    _submit(FakeSQL(), [(2, {'SN': 'ok'}), (3, {'SN': 'bad'}),
+                        (4, {'SN': 'zero'}), (5, {'SN': 'ok'})],
+            report, userID=1, statusID=1, request_key=None)
+    assert report.created == 2 and [line for line, _, _ in report.errors] \
+        == [3, 4], report.errors
+    assert report.errors[0][2].endswith('Нарушение ограничения')
+    try:
+        _submit(FakeSQL(), [(6, {'SN': 'bad'}), (7, {'SN': 'lost'}),
+                            (8, {'SN': 'ok'})],
+                report, userID=1, statusID=1, request_key=None)
+    except RepairImportError:
+        pass
+    assert [message[:6] for _, _, message in report.errors[2:]] == \
+        ['Сервер', 'Ошибка', 'Ремонт'], report.errors
+    print('Rejected rows are reported:', report.errors)
+
+    # every counted row is created or reported when import is stopped
+    import threading
+
+    class FakeConn(object):
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        create_repairs = FakeSQL.create_repairs
+
+        def get_object_owner_info(self, sn, date_broken):
+            if date_broken.year == 2021:
+                return None  # network error
+            return [('Владелец', 'РЦ', 'Склад')]
+
+    lines = [(i, {'Серийный номер': 'SN1', 'Дата поломки': '01.02.2020'})
+             for i in range(2, 8)]
+    cancel = threading.Event()
+
+    def cancelled_rows():
+        for i, values in lines:
+            if i == 5:
+                cancel.set()
+            yield i, values
+
+    for source, kwargs in (
+            (cancelled_rows(), {'cancel': cancel}),
+            (lines[:3] + [(9, {'Серийный номер': 'SN1',
+                               'Дата поломки': '01.02.2021'})], {})):
+        report = import_repairs(source, FakeConn(), userID=1, statusID=1,
+                                tech_info={'SN1': ()}, measure_units={},
+                                batch_size=10, **kwargs)
+        assert report.total == 3 and report.created == 0 \
+            and len(report.errors) == 3, report.summary()
+    print('Pending rows are reported when import is stopped.')
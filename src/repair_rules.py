@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Feb 11 11:08:15 2020
+
+@author: v.shkaberda
+
+Rules of repair info correctness shared by creating form and import.
+"""
+from datetime import datetime
+
+
+def float_form(text):
+    """ Returns text formatted in a such way, that it can be converted
+        into a float without an error ('1 234,5' -> '1234.5').
+    """
+    return text.replace(' ', '').replace('\n', '').replace(',', '.')
+
+
+def convert_date(date_in, output=None):
+    """ Take date_in and convert it into output format.
+        If output is None datetime object is returned.
+
+        date: str in format '%d[./]%m[./]%y' or '%d[./]%m[./]%Y'.
+        output: str or None, output format.
+    """
+    date_in = date_in.replace('/', '.')
+    try:
+        dat = datetime.strptime(date_in, '%d.%m.%y')
+    except ValueError:
+        dat = datetime.strptime(date_in, '%d.%m.%Y')
+    if output:
+        return dat.strftime(output)
+    return dat
+
+
+def check_repair(*, workhours, number_units, units_measure, rc, store,
+                 date_broken):
+    """ Returns message describing the first incorrect field or None
+        if repair info is correct. Values are str as entered in form.
+    """
+    try:
+        float(float_form(workhours) or 0)
+    except ValueError:
+        return 'Некорректно заполнено: Моточасы'
+    try:
+        number_units = float(float_form(number_units) or 0)
+    except ValueError:
+        return 'Некорректно заполнено: Кол-во запчастей'
+    if number_units and not units_measure:
+        return 'Не указана ед. измерения запчастей'
+    if not rc:
+        return 'Не указано РЦ'
+    if not store:
+        return 'Не указан склад'
+    try:
+        convert_date(date_broken)
+    except ValueError:
+        return 'Дата поломки некорректна или не заполнена'
+    except Exception as e:
+        return 'Возникло непредвиденное исключение\n{}'.format(e)
@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Feb 17 10:12:09 2020
+
+@author: v.shkaberda
+
+Local SQLite replica of repair list. It is synced by changes made since
+the latest synced change (watermark) instead of loading the whole list,
+filters and ordering are applied by indexed queries.
+"""
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from time import monotonic
+import sqlite3
+import threading
+
+# changes made shortly before watermark are requested again, since
+# transactions committed later may have earlier modification time
+SYNC_OVERLAP = timedelta(minutes=5)
+
+# version of table layout, file of other version is synced from scratch
+SCHEMA_VERSION = 2
+
+ReplicaDiff = namedtuple('ReplicaDiff', ['missing', 'extra', 'changed'])
+
+# values are stored in types keeping their order in sqlite; Decimal is
+# kept as text (column with NUMERIC affinity would turn it into REAL),
+# so it's ordered as number by CAST
+sqlite3.register_adapter(Decimal, str)
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+sqlite3.register_adapter(date, lambda value: value.isoformat())
+sqlite3.register_converter('DECIMAL_TEXT',
+                           lambda value: Decimal(value.decode()))
+sqlite3.register_converter(
+    'DATETIME', lambda value: datetime.fromisoformat(value.decode()))
+sqlite3.register_converter(
+    'DATE', lambda value: date.fromisoformat(value.decode()))
+
+
+def _column_type(value):
+    """ Declared type of column by its value (see converters above). """
+    if isinstance(value, datetime):
+        return 'DATETIME'
+    if isinstance(value, date):
+        return 'DATE'
+    if isinstance(value, Decimal):
+        return 'DECIMAL_TEXT'
+    if isinstance(value, int):
+        return 'INTEGER'
+    if isinstance(value, float):
+        return 'REAL'
+    return 'TEXT'
+
+
+class RepairReplica(object):
+    """ Repair list kept in SQLite file.
+
+    fname - str, database file (created if missing);
+    columns - sequence of column names in the order of row values,
+        the first column is ID.
+    Rows changed on server are got as (*values, modified_at, is_deleted),
+    see DBConnect.iter_repair_changes. Every thread uses its own connection,
+    so sync in worker thread doesn't block reading.
+
+    synced_at - time (monotonic) of the latest successful sync in this
+        process or None (rows of file may be outdated).
+    File made by other version or for other columns is cleared.
+    """
+    def __init__(self, fname, columns):
+        self.fname = fname
+        self.columns = {col: i for i, col in enumerate(columns)}
+        self.width = len(self.columns)
+        self.synced_at = None
+        self._local = threading.local()
+        self._indexes = set()  # indexed columns, tuple of positions
+        self._decimals = None  # positions of Decimal columns
+        with self._db() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS meta '
+                       '(key TEXT PRIMARY KEY, value)')
+            if not self._schema_matches():
+                db.execute('DROP TABLE IF EXISTS repairs')
+                db.execute('DELETE FROM meta')
+                db.execute('INSERT INTO meta VALUES (?, ?)',
+                           ('schema', SCHEMA_VERSION))
+
+    def _schema_matches(self):
+        """ Check version of file and columns of table. """
+        if self._get_meta('schema') != SCHEMA_VERSION:
+            return False
+        if not self._has_table():
+            return True
+        names = [row[1] for row in
+                 self._db().execute('PRAGMA table_info(repairs)')]
+        return names == (['c{}'.format(i) for i in range(self.width)]
+                         + ['modified_at'])
+
+    def _decimal_columns(self):
+        """ Positions of columns declared as DECIMAL_TEXT. """
+        if self._decimals is None and self._has_table():
+            self._decimals = {
+                row[0] for row in
+                self._db().execute('PRAGMA table_info(repairs)')
+                if row[2] == 'DECIMAL_TEXT'}
+        return self._decimals or set()
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.fname, timeout=30,
+                                 detect_types=sqlite3.PARSE_DECLTYPES)
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+        return db
+
+    def _get_meta(self, key):
+        row = self._db().execute('SELECT value FROM meta WHERE key = ?',
+                                 (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _has_table(self):
+        return self._db().execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+            "AND name = 'repairs'").fetchone() is not None
+
+    def _create_table(self, rows):
+        """ Table is created by the first rows, types of columns are
+            taken from their values.
+        """
+        types = [_column_type(next((row[i] for row in rows
+                                    if row[i] is not None), None))
+                 for i in range(self.width)]
+        columns = ', '.join('c{} {}'.format(i, col_type) for i, col_type
+                            in enumerate(types) if i)
+        self._db().execute('CREATE TABLE repairs (c0 INTEGER PRIMARY KEY, '
+                           '{}, modified_at DATETIME)'.format(columns))
+
+    def _ensure_index(self, positions):
+        """ Create index on columns once (it's kept in file). """
+        positions = tuple(positions)
+        if positions in self._indexes:
+            return
+        self._db().execute(
+            'CREATE INDEX IF NOT EXISTS ix_{} ON repairs ({})'.format(
+                '_'.join(map(str, positions)),
+                ', '.join('c{}'.format(i) for i in positions)))
+        self._indexes.add(positions)
+
+    def _upsert(self, rows):
+        """ Insert or replace rows (*values, modified_at). """
+        self._db().executemany(
+            'INSERT OR REPLACE INTO repairs VALUES ({})'.format(
+                ', '.join('?' * (self.width + 1))), rows)
+
+    def is_empty(self):
+        """ True if replica has never been synced. """
+        return self._get_meta('watermark') is None
+
+    def modified_since(self):
+        """ Returns time changes are requested from (None - all rows). """
+        watermark = self._get_meta('watermark')
+        if watermark is None:
+            return None
+        return datetime.fromisoformat(watermark) - SYNC_OVERLAP
+
+    def _apply(self, rows):
+        """ Apply changed rows, returns the latest modification time. """
+        # the last change of repair wins
+        last = {row[0]: row for row in rows}.values()
+        deleted = [(row[0],) for row in last if row[-1]]
+        if deleted:
+            self._db().executemany('DELETE FROM repairs WHERE c0 = ?',
+                                   deleted)
+        self._upsert([row[:-1] for row in last if not row[-1]])
+        return max(row[-2] for row in rows)
+
+    def sync(self, batches):
+        """ Apply batches of changed rows (ordered by modification time)
+            in one transaction. Returns number of applied rows.
+            If batches are interrupted by exception, replica isn't changed.
+        """
+        db = self._db()
+        watermark = self._get_meta('watermark')
+        watermark = watermark and datetime.fromisoformat(watermark)
+        changed = 0
+        # until table is created rows are kept to find types of columns
+        # (column may be empty in the first rows)
+        pending = None if self._has_table() else []
+        with db:
+            for rows in batches:
+                changed += len(rows)
+                if pending is not None:
+                    pending.extend(rows)
+                    if not pending or any(
+                            all(row[i] is None for row in pending)
+                            for i in range(self.width)):
+                        continue
+                    self._create_table(pending)
+                    rows, pending = pending, None
+                if not rows:
+                    continue
+                latest = self._apply(rows)
+                if watermark is None or latest > watermark:
+                    watermark = latest
+            if pending:
+                self._create_table(pending)
+                latest = self._apply(pending)
+                watermark = max(watermark or latest, latest)
+            # the first sync of empty list has no watermark either
+            db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                       ('watermark', (watermark or datetime(1900, 1, 1))
+                        .isoformat(' ')))
+        self.synced_at = monotonic()
+        return changed
+
+    def select(self, criteria=None, order=None):
+        """ Returns list of rows matching all criteria.
+
+            criteria - dict {column name: value};
+            order - list of (column index, reverse), by default rows are
+                ordered by ID descending.
+        """
+        if not self._has_table():
+            return []
+        criteria = criteria or {}
+        where = [self.columns[col] for col in criteria]
+        order = order or [(0, True)]
+        if where:
+            self._ensure_index(sorted(where))
+        if order != [(0, True)]:  # ID is primary key
+            self._ensure_index(i for i, _ in order)
+        query = 'SELECT {} FROM repairs'.format(
+            ', '.join('c{}'.format(i) for i in range(self.width)))
+        if where:
+            query += ' WHERE ' + ' AND '.join('c{} = ?'.format(i)
+                                              for i in where)
+        decimals = self._decimal_columns()
+        query += ' ORDER BY ' + ', '.join(
+            ('CAST(c{} AS REAL){}' if i in decimals else 'c{}{}').format(
+                i, ' DESC' if reverse else '')
+            for i, reverse in order)
+        return self._db().execute(query, list(criteria.values())).fetchall()
+
+    def check(self, batches):
+        """ Compare replica with full repair list (batches of rows, e.g.
+            DBConnect.iter_repair_list). Returns ReplicaDiff of lists of ID.
+        """
+        local = {row[0]: row for row in self.select()}
+        missing, changed = [], []
+        for rows in batches:
+            for row in rows:
+                row = tuple(row)
+                stored = local.pop(row[0], None)
+                if stored is None:
+                    missing.append(row[0])
+                elif stored != row:
+                    changed.append(row[0])
+        return ReplicaDiff(missing, sorted(local), changed)
+
+    def fix(self, batches, diff):
+        """ Make replica equal to full repair list using result of check.
+        """
+        ids = set(diff.missing) | set(diff.changed)
+        with self._db() as db:
+            for rows in batches:
+                if not self._has_table():
+                    self._create_table(rows)
+                self._upsert([(*row, None) for row in rows if row[0] in ids])
+            db.executemany('DELETE FROM repairs WHERE c0 = ?',
+                           [(i,) for i in diff.extra])
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) > 3:
+        # consistency check: replica.py server db replica_file [--fix]
+        from db_connect import DBConnect
+
+        conn = DBConnect(server=sys.argv[1], db=sys.argv[2])
+        columns = range(20)  # names aren't used by check
+        replica = RepairReplica(sys.argv[3], columns)
+        filters = dict.fromkeys(('created_by', 'rc', 'store', 'owner',
+                                 'mfr', 'tech_type', 'status'))
+        with conn as sql:
+            diff = replica.check(sql.iter_repair_list(**filters))
+            print('missing: {}, extra: {}, changed: {}'.format(
+                *map(len, diff)))
+            if '--fix' in sys.argv and any(diff):
+                replica.fix(sql.iter_repair_list(**filters), diff)
+                print('Replica is fixed.')
+        sys.exit(1 if any(diff) and '--fix' not in sys.argv else 0)
+
+    # self-check with generated changes
+    from random import choice, randint, seed
+    from tempfile import mkdtemp
+    import os
+
+    seed(0)
+    columns = ('ID', 'Статус', 'Дата', 'Сумма', 'Дата поломки')
+    server = {}
+    clock = [datetime(2020, 1, 1)]
+
+    def change(n):
+        """ Change n random repairs on "server", returns changed rows. """
+        rows = []
+        for _ in range(n):
+            clock[0] += timedelta(seconds=randint(1, 100))
+            i = randint(1, 300)
+            deleted = i in server and randint(0, 9) == 0
+            row = (i, choice(('Новый', 'В работе', 'Удал.')), clock[0],
+                   Decimal(randint(0, 10**6)) / 100,
+                   date(2020, 1, randint(1, 31)))
+            if deleted:
+                del server[i]
+            else:
+                server[i] = row
+            rows.append((*row, clock[0], deleted))
+        return rows
+
+    replica = RepairReplica(os.path.join(mkdtemp(), 'replica.db'), columns)
+    changes = change(1000)
+    replica.sync([changes[:400], changes[400:]])
+    for _ in range(5):
+        since = replica.modified_since()
+        changes += change(50)
+        replica.sync([[row for row in changes if row[-2] >= since]])
+    assert not any(replica.check([list(server.values())])), 'Not synced.'
+    expected = sorted((row for row in server.values() if row[1] == 'Новый'),
+                      key=lambda row: (row[3], -row[0]))
+    assert replica.select({'Статус': 'Новый'},
+                          order=[(3, False), (0, True)]) == expected
+    # Decimal keeps its digits (isn't stored as REAL)
+    assert all(str(row[3]) == str(server[row[0]][3])
+               for row in replica.select()), 'Decimal is changed.'
+    del server[next(iter(server))]
+    diff = replica.check([list(server.values())])
+    assert len(diff.extra) == 1 and not diff.missing + diff.changed
+    replica.fix([list(server.values())], diff)
+    assert not any(replica.check([list(server.values())])), 'Not fixed.'
+    assert RepairReplica(replica.fname, columns).select(), 'Replica is lost.'
+    print('Replica works: {} rows.'.format(len(replica.select())))
+
+    # file of other layout is synced from scratch
+    db = sqlite3.connect(replica.fname)
+    with db:
+        db.execute('UPDATE meta SET value = 1 WHERE key = ?', ('schema',))
+    db.close()
+    reopened = RepairReplica(replica.fname, columns)
+    assert reopened.is_empty() and not reopened.select()
+    reopened.sync([changes])
+    assert not RepairReplica(replica.fname, columns).is_empty()
+    assert RepairReplica(replica.fname, columns[:-1]).is_empty()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Jan 29 12:36:02 2020
+
+@author: v.shkaberda
+"""
+from decimal import Decimal
+
+# '1,234.50' -> '1 234,50'
+_SEPARATORS = str.maketrans(',.', ' ,')
+
+
+def format_float(sum_float):
+    return '{:,.2f}'.format(sum_float).translate(_SEPARATORS)
+
+
+def format_rows(rows, tag_col):
+    """ Returns list of (values, tags) to be shown in table.
+        Rows are formatted column by column: Decimal values as numbers
+        with two decimals, None as empty string.
+
+        tag_col: int, index of column which value is used as tag.
+    """
+    if not rows:
+        return []
+    fmt = '{:,.2f}'.format
+    columns = []
+    for values in zip(*rows):
+        types = set(map(type, values))
+        if type(None) in types:
+            values = ['' if val is None else val for val in values]
+        if Decimal in types:
+            values = list(values)
+            pos = [i for i, val in enumerate(values) if type(val) is Decimal]
+            # separators of the whole column are replaced at once
+            formatted = ('\n'.join([fmt(values[i]) for i in pos])
+                         .translate(_SEPARATORS).split('\n'))
+            for i, val in zip(pos, formatted):
+                values[i] = val
+        columns.append(values)
+    return [(values, (row[tag_col],))
+            for values, row in zip(zip(*columns), rows)]
+
+
+class DisplayCache(object):
+    """ Formatted (values, tags) of rows, every row is formatted once.
+
+    Rows are kept by identity, so cache is valid while the same row
+    objects are shown (sorting, filtering, appended pages).
+    Call clear() when rows are fetched again.
+    """
+    def __init__(self, tag_col):
+        self.tag_col = tag_col
+        self._cache = {}  # {id(row): (row, display)}
+
+    def clear(self):
+        self._cache = {}
+
+    def get(self, rows):
+        """ Returns list of (values, tags) for rows. """
+        cache = self._cache
+        missing = [row for row in rows if id(row) not in cache]
+        if missing:
+            cache.update(zip(map(id, missing),
+                             zip(missing, format_rows(missing, self.tag_col))))
+        return [cache[id(row)][1] for row in rows]
+
+
+if __name__ == '__main__':
+    from random import randint, seed
+    from time import perf_counter
+
+    seed(0)
+    rows = [(i, 'Иванов', None, 1, 'Созд.', 'РЦ', 'Склад', None,
+             'Собственник', 'Погрузчик', 'Toyota', 'Модель', 'SN{}'.format(i),
+             Decimal(randint(0, 10**7)) / 100, None, None, 'Описание', None,
+             Decimal(randint(0, 1000)) / 10, 'шт')
+            for i in range(50000)]
+
+    def render_old(rows):
+        """ Render loop used before: format every cell on every render. """
+        old_format = lambda val: ('{:,.2f}'.format(val).replace(',', ' ')
+                                                      .replace('.', ','))
+        return [(tuple(map(lambda val: old_format(val)
+                 if isinstance(val, Decimal) else '' if val is None else val,
+                 row)), (row[4],)) for row in rows]
+
+    cache = DisplayCache(tag_col=4)
+    for name, render in (('per cell (old)', render_old),
+                         ('bulk by columns', lambda r: format_rows(r, 4)),
+                         ('cache, first', cache.get),
+                         ('cache, re-render', cache.get),
+                         ('cache, sorted', lambda r: cache.get(r[::-1]))):
+        start = perf_counter()
+        result = render(rows)
+        print('{:<18} {:>7.1f} ms'.format(name,
+                                         (perf_counter() - start) * 1000))
+        assert sorted(result) == sorted(render_old(rows))
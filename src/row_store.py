@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Feb  3 09:55:12 2020
+
+@author: v.shkaberda
+"""
+from array import array
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from row_format import format_rows
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def _mask(values):
+    """ Returns bytearray with 1 for None values or None if there are no
+        None values.
+    """
+    if None not in values:
+        return None
+    return bytearray(val is None for val in values)
+
+
+class _ArrayColumn(object):
+    """ Column stored in typed array, None values are marked in mask.
+        fits - function (value) returning True if not None value can be
+        stored by encode.
+    """
+    def __init__(self, values, typecode, encode, decode, fits):
+        self.mask = _mask(values)
+        self.data = array(typecode, (0 if val is None else encode(val)
+                                     for val in values))
+        self.encode = encode
+        self.decode = decode
+        self.fits = fits
+
+    def extend(self, values):
+        """ Append values, returns False if they can't be stored
+            (column isn't changed then).
+        """
+        if not all(val is None or self.fits(val) for val in values):
+            return False
+        try:
+            data = array(self.data.typecode,
+                         (0 if val is None else self.encode(val)
+                          for val in values))
+        except OverflowError:
+            return False
+        mask = _mask(values)
+        if mask is not None and self.mask is None:
+            self.mask = bytearray(len(self.data))
+        if self.mask is not None:
+            self.mask.extend(mask or bytes(len(values)))
+        self.data.extend(data)
+        return True
+
+    def __getitem__(self, i):
+        if self.mask is not None and self.mask[i]:
+            return None
+        return self.decode(self.data[i])
+
+    def nbytes(self):
+        return (self.data.itemsize * len(self.data)
+                + (len(self.mask) if self.mask is not None else 0))
+
+    def values(self):
+        decoded = list(map(self.decode, self.data))
+        if self.mask is not None:
+            for i, is_none in enumerate(self.mask):
+                if is_none:
+                    decoded[i] = None
+        return decoded
+
+
+class _DictColumn(object):
+    """ Column of repeated values: codes in typed array refer to the list
+        of distinct values.
+    """
+    def __init__(self, values):
+        self.codes = {}
+        self.distinct = []
+        self.data = array('H')
+        self.extend(values)
+
+    def extend(self, values):
+        """ Append values (any values can be stored). """
+        codes = self.codes
+        for val in values:
+            if val not in codes:
+                codes[val] = len(self.distinct)
+                self.distinct.append(val)
+        if self.data.typecode == 'H' and len(self.distinct) >= 2 ** 16:
+            self.data = array('I', self.data)
+        self.data.extend(map(codes.__getitem__, values))
+        return True
+
+    def __getitem__(self, i):
+        return self.distinct[self.data[i]]
+
+    def nbytes(self):
+        return self.data.itemsize * len(self.data)
+
+    def values(self):
+        return list(map(self.distinct.__getitem__, self.data))
+
+
+def _make_column(values):
+    """ Choose compact storage according to type of values. """
+    types = set(map(type, values)) - {type(None)}
+    try:
+        if types == {int}:
+            return _ArrayColumn(values, 'q', int, int,
+                                lambda val: type(val) is int)
+        if types == {Decimal} and all(val.is_finite() for val in values
+                                      if val is not None):
+            # stored as integers scaled by the max number of decimal places
+            scale = max(0, max(-val.as_tuple().exponent for val in values
+                               if val is not None))
+            return _ArrayColumn(
+                values, 'q',
+                lambda val: int(val.scaleb(scale)),
+                lambda val: Decimal(val).scaleb(-scale),
+                lambda val: (type(val) is Decimal and val.is_finite()
+                             and -val.as_tuple().exponent <= scale))
+        if types == {datetime} and all(val.tzinfo is None for val in values
+                                       if val is not None):
+            return _ArrayColumn(
+                values, 'q',
+                lambda val: (val - _EPOCH) // _MICROSECOND,
+                lambda val: _EPOCH + val * _MICROSECOND,
+                lambda val: type(val) is datetime and val.tzinfo is None)
+        if types == {date}:
+            return _ArrayColumn(values, 'l', date.toordinal, date.fromordinal,
+                                lambda val: type(val) is date)
+    except OverflowError:
+        pass  # values don't fit into typed array
+    return _DictColumn(values)
+
+
+class ColumnarRows(object):
+    """ Compact read-only storage of rows.
+
+    Numeric and date columns are kept in typed arrays, other columns
+    (e.g. repeated strings) are dictionary encoded.
+    Rows are materialized as tuples on access, column(col) returns
+    all values of column at once (decoded columns are cached until
+    rows are added).
+    """
+    def __init__(self, rows):
+        rows = list(rows)
+        self._len = len(rows)
+        self._columns = [_make_column(values) for values in zip(*rows)]
+        self._decoded = {}
+
+    def extend(self, rows):
+        """ Append rows in place, only columns that can't store new values
+            (e.g. type differs) are rebuilt.
+        """
+        rows = list(rows)
+        if not rows:
+            return
+        if not self._len:
+            # types of columns are known only from values
+            self.__init__(rows)
+            return
+        self._decoded.clear()
+        for col, values in enumerate(zip(*rows)):
+            if not self._columns[col].extend(values):
+                self._columns[col] = _make_column(
+                    self._columns[col].values() + list(values))
+        self._len += len(rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._len))]
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError('row index out of range')
+        return tuple(column[i] for column in self._columns)
+
+    def __iter__(self):
+        return zip(*(column.values() for column in self._columns))
+
+    def __len__(self):
+        return self._len
+
+    def column(self, col):
+        """ Returns list of decoded values of column col (it's shared,
+            so it mustn't be changed).
+        """
+        if not self._len:
+            return []  # empty store has no columns
+        try:
+            return self._decoded[col]
+        except KeyError:
+            values = self._decoded[col] = self._columns[col].values()
+            return values
+
+    def nbytes(self):
+        """ Approximate size of stored data. """
+        return sum(column.nbytes() for column in self._columns)
+
+    def view(self, positions):
+        return RowsView(self, positions)
+
+
+def row_ids(rows):
+    """ Returns {ID: position} of rows (list, ColumnarRows or RowsView),
+        ID is the first value of row.
+    """
+    if not len(rows):
+        return {}
+    ids = (rows.column(0) if hasattr(rows, 'column')
+           else [row[0] for row in rows])
+    return dict(zip(ids, range(len(ids))))
+
+
+class RowsView(object):
+    """ Rows of ColumnarRows in given order (e.g. sorted or filtered). """
+    def __init__(self, store, positions):
+        self.store = store
+        self.positions = list(positions)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.store[pos] for pos in self.positions[i]]
+        return self.store[self.positions[i]]
+
+    def __iter__(self):
+        return (self.store[pos] for pos in self.positions)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def column(self, col):
+        values = self.store.column(col)
+        return [values[pos] for pos in self.positions]
+
+    def view(self, positions):
+        return RowsView(self.store, [self.positions[i] for i in positions])
+
+
+class LazyDisplay(object):
+    """ (values, tags) of rows for table formatted only on access,
+        so only visible rows are formatted in virtual mode.
+        keys are the first values of rows (used to find selected row).
+    """
+    def __init__(self, rows, tag_col):
+        self.rows = rows
+        self.tag_col = tag_col
+        self._keys = None
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return format_rows(self.rows[i], self.tag_col)
+        return format_rows([self.rows[i]], self.tag_col)[0]
+
+    def __iter__(self):
+        return iter(format_rows(list(self.rows), self.tag_col))
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def keys(self):
+        if self._keys is None:
+            self._keys = self.rows.column(0)
+        return self._keys
+
+
+if __name__ == '__main__':
+    from random import choice, randint, seed
+    import tracemalloc
+
+    def make_rows(n):
+        """ Rows similar to get_repair_list output, strings are created
+            separately for every row as pyodbc does.
+        """
+        seed(0)
+        rows = []
+        for i in range(n):
+            rows.append((
+                i, ''.join(('Иванов ', 'И.И.')), datetime(2020, 1, 1, 12),
+                randint(1, 3), ''.join(('Созд', '.')),
+                ''.join(('РЦ ', choice(('Киев', 'Львов', 'Одесса')))),
+                ''.join(('Склад ', str(randint(1, 5)))), None,
+                ''.join(('Собственник ', str(randint(1, 3)))),
+                ''.join(('Погрузчик ', 'электрический')),
+                ''.join(('Jung', 'heinrich')), ''.join(('ETV ', str(randint(1, 20)))),
+                'SN{:08}'.format(i), Decimal(randint(0, 10**7)) / 100,
+                date(2019, randint(1, 12), randint(1, 28)), None,
+                ''.join(('Не ', 'заводится')), None,
+                Decimal(randint(0, 1000)) / 10, ''.join(('ш', 'т'))))
+        return rows
+
+    n = 100000
+    tracemalloc.start()
+    rows = make_rows(n)
+    list_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    store = ColumnarRows(make_rows(n))  # source rows are freed
+    store_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print('{} rows'.format(n))
+    print('list of tuples:  {:>7.1f} MB'.format(list_size / 2**20))
+    print('ColumnarRows:    {:>7.1f} MB'.format(store_size / 2**20))
+    assert list(store) == rows and store[-1] == rows[-1]
+    assert store.view([5, 1])[0] == rows[5]
+    assert store.column(3) is store.column(3), 'Column is decoded again.'
+
+    # empty result (e.g. filter without matches) is sorted and extended
+    empty = ColumnarRows([])
+    assert len(empty) == 0 and empty.column(0) == [] and list(empty) == []
+    assert empty.view([]).column(3) == []
+    assert row_ids(empty) == {} and row_ids([]) == {}
+    assert row_ids(store.view([2, 0])) == {2: 0, 0: 1} == row_ids(
+        [rows[2], rows[0]])
+    empty.extend(rows[:10])
+    assert list(empty) == rows[:10] and empty.column(0) == list(range(10))
+
+    # pages are added in place, new None values and types are accepted
+    store = ColumnarRows(rows[:1000])
+    columns = list(store._columns)
+    extra = [(None, *row[1:13], Decimal('0.001'), *row[14:])
+             for row in rows[1000:1010]]
+    for start in range(1000, 5000, 1000):
+        store.extend(rows[start:start + 1000])
+    store.extend(extra)
+    assert list(store) == rows[:5000] + extra
+    assert len(store) == 5010 and store.column(0)[-1] is None
+    assert store._columns[1] is columns[1], 'Column is rebuilt.'
+    print('Columnar rows are extended in place.')
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Jan 27 10:18:55 2020
+
+@author: v.shkaberda
+"""
+
+
+class SortIndex(object):
+    """ Cached sort permutations of rows.
+
+    For every column ascending permutation (None values go last) and
+    ranks of rows are computed once, until rows are replaced.
+    Descending order is the permutation read backwards.
+    """
+    def __init__(self, rows):
+        self.rows = rows
+        self._perms = {}
+        self._ranks = {}
+        self._orders = {}  # multi-column permutations
+
+    def _values(self, col):
+        """ Returns list of values of column col. """
+        if hasattr(self.rows, 'column'):  # columnar storage
+            return self.rows.column(col)
+        return [row[col] for row in self.rows]
+
+    def perm(self, col):
+        """ Returns ascending permutation of rows by column col. """
+        try:
+            return self._perms[col]
+        except KeyError:
+            pass
+        values = self._values(col)
+        perm = sorted(range(len(values)),
+                      key=lambda i: (values[i] is None, values[i]))
+        self._perms[col] = perm
+        return perm
+
+    def ranks(self, col):
+        """ Returns list, where ranks[i] is the position of rows[i] value
+            in sorted distinct values of column col.
+        """
+        try:
+            return self._ranks[col]
+        except KeyError:
+            pass
+        values = self._values(col)
+        ranks = [0] * len(values)
+        rank = -1
+        previous = object()
+        for i in self.perm(col):
+            value = values[i]
+            if value != previous or rank < 0:
+                rank += 1
+                previous = value
+            ranks[i] = rank
+        self._ranks[col] = ranks
+        return ranks
+
+    def order(self, columns):
+        """ Returns permutation of rows sorted by columns.
+
+            columns: sequence of (column index, reverse), the first one
+                is the most significant. Sorting is stable.
+        """
+        if not columns:
+            return range(len(self.rows))
+        if len(columns) == 1:
+            col, reverse = columns[0]
+            perm = self.perm(col)
+            return perm[::-1] if reverse else perm
+        columns = tuple(columns)
+        try:
+            return self._orders[columns]
+        except KeyError:
+            pass
+        perm = list(range(len(self.rows)))
+        # stable sort from the least significant column
+        for col, reverse in reversed(columns):
+            perm.sort(key=self.ranks(col).__getitem__, reverse=reverse)
+        self._orders[columns] = perm
+        return perm
+
+
+if __name__ == '__main__':
+    from random import choice, random, seed
+    from time import perf_counter
+
+    seed(0)
+    rows = [(i, choice(('РЦ1', 'РЦ2', 'РЦ3', None)), random(),
+             choice(('Созд.', 'Фикс.', 'Удал.')))
+            for i in range(50000)]
+    index = SortIndex(rows)
+    for columns in (((2, False),), ((2, True),), ((1, False), (3, True)),
+                    ((1, False), (3, True))):
+        start = perf_counter()
+        perm = index.order(columns)
+        print('{:<25} {:>7.1f} ms'.format(
+            str(columns), (perf_counter() - start) * 1000))
+    expected = sorted(rows, key=lambda x: x[3], reverse=True)
+    expected.sort(key=lambda x: (x[1] is None, x[1]))
+    assert [rows[i] for i in perm] == expected
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Jan 22 15:27:40 2020
+
+@author: v.shkaberda
+
+Startup timing trace. Every launch appends one json line with durations
+of startup phases and its outcome to startup_trace.log (next to log.txt),
+aborted launches included.
+Run this module to aggregate trace files into percentile tables:
+    python startup_trace.py [file1 file2 ...]
+"""
+from collections import defaultdict
+from os import getcwd, path
+from time import monotonic
+import json
+import math
+import time
+
+TRACE_FILE = 'startup_trace.log'
+
+
+class StartupTrace(object):
+    """ Collects durations (ms) of startup phases.
+        Time is counted from creation of the trace.
+    """
+    def __init__(self):
+        self.started = monotonic()
+        self._last = self.started
+        self.phases = {}
+        self.info = {}  # additional fields, e.g. user and version
+        self.outcome = None  # why launch has stopped, None - it's running
+        self.written = False
+
+    def mark(self, phase):
+        """ Record the phase that has just finished. """
+        now = monotonic()
+        self.phases[phase] = round((now - self._last) * 1000, 1)
+        self._last = now
+
+    def write(self, fname=None, outcome=None):
+        """ Append trace as one json line, only the first call of launch
+            writes it.
+
+            outcome - str, result of launch (by default self.outcome or 'ok').
+        """
+        if self.written:
+            return
+        self.written = True
+        fname = fname or path.join(getcwd(), TRACE_FILE)
+        record = {'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  **self.info,
+                  'outcome': outcome or self.outcome or 'ok',
+                  'phases': self.phases,
+                  'total': round((self._last - self.started) * 1000, 1)}
+        with open(fname, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile of sorted values. """
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[rank - 1]
+
+
+def summarize(fnames):
+    """ Returns {version: {phase: sorted durations}}, only launches
+        that have shown the app are counted.
+    """
+    summary = defaultdict(lambda: defaultdict(list))
+    for fname in fnames:
+        try:
+            f = open(fname, encoding='utf-8')
+        except FileNotFoundError:
+            print('File not found: {}'.format(fname))
+            continue
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('outcome', 'ok') != 'ok':
+                    continue
+                phases = summary[record.get('version', '?')]
+                for phase, duration in record['phases'].items():
+                    phases[phase].append(duration)
+                phases['total'].append(record['total'])
+    for phases in summary.values():
+        for durations in phases.values():
+            durations.sort()
+    return summary
+
+
+def print_summary(summary):
+    for version in sorted(summary):
+        print('Version {}'.format(version))
+        print('{:<22}{:>6}{:>10}{:>10}{:>10}{:>10}'.format(
+            'phase, ms', 'n', 'p50', 'p90', 'p99', 'max'))
+        for phase, durations in summary[version].items():
+            print('{:<22}{:>6}{:>10}{:>10}{:>10}{:>10}'.format(
+                phase, len(durations),
+                *(percentile(durations, p) for p in (50, 90, 99)),
+                durations[-1]))
+        print()
+
+
+if __name__ == '__main__':
+    import sys
+    print_summary(summarize(sys.argv[1:] or [TRACE_FILE]))
@@ -6,14 +6,33 @@ Created on Wed Nov 20 13:06:13 2019
 """
 
 from _version import __version__
-from autocomplete_entry import AutocompleteEntry
+from autocomplete_entry import AutocompleteEntry, SubstringIndex
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from decimal import Decimal
-from functools import wraps
+from db_connect import OfflineError, StreamInterruptedError
+from functools import partial, wraps
+from log_error import writelog
+from owner_history import OwnerHistoryCache
+from ref_cache import ExpiringValue
+from repair_export import ExportReport, export_rows
+from repair_filter import RepairFilter
+from repair_import import (ImportReport, import_repairs, read_rows,
+                           RepairImportError)
+from repair_rules import check_repair, convert_date, float_form
+from replica import RepairReplica
+from row_format import DisplayCache
+from row_store import ColumnarRows, LazyDisplay, row_ids
+from sort_index import SortIndex
 from tkcalendar import DateEntry
-from tkinter import ttk, messagebox
+from tkinter import filedialog, messagebox, ttk
+from time import monotonic
 from tkHyperlinkManager import HyperlinkManager
+from uuid import uuid4
+from virtual_treeview import VirtualTreeview
 import os
+import queue
+import sqlite3
+import threading
 import tkinter as tk
 
 
@@ -22,6 +41,16 @@ EMAIL_TO = b'\xd0\xa4\xd0\xbe\xd0\xb7\xd0\xb7\xd0\xb8|\xd0\x9b\
 \xd0\xbe\xd0\xb3\xd0\xb8\xd1\x81\xd1\x82\xd0\xb8\xd0\xba\xd0\xb0|\xd0\x90\
 \xd0\xbd\xd0\xb0\xd0\xbb\xd0\xb8\xd1\x82\xd0\xb8\xd0\xba\xd0\xb8'.decode()
 
+# metrics of db procedures are appended here (Справка -> Диагностика)
+METRICS_FILE = 'db_metrics.log'
+
+# columns of table in order of CreateCopyFrame._set_current_repair arguments
+FORM_COLUMNS = ('Серийный номер', 'Наряд-заказ', 'Вид техники', 'Модель',
+                'Собственник', 'Производитель', 'Дата поломки',
+                'Текущие моточасы', 'РЦ', 'Склад', 'Кол-во единиц',
+                'Ед. изм.', 'Описание неисправности', 'Проведённые работы',
+                'Дата завершения ремонта')
+
 
 def deco_check_conn(method, *args, **kwargs):
     """ Decorator raises Error when no connection provided.
@@ -138,9 +167,7 @@ class StringSumVar(tk.StringVar):
         it can be converted into a float without an error.
     """
     def get_float_form(self, *args, **kwargs):
-        return (super().get(*args, **kwargs).replace(' ', '')
-                                            .replace('\n', '')
-                                            .replace(',', '.'))
+        return float_form(super().get(*args, **kwargs))
 
 
 class RepairTk(tk.Tk):
@@ -205,7 +232,10 @@ class RepairTk(tk.Tk):
 
 
 class RepairApp():
-    def __init__(self, root, connection, user_info, references):
+    def __init__(self, root, connection, user_info, references, page_size=0,
+                 filter_max_age=0, ref_cache=None, refs_ttl=600, trace=None,
+                 columnar=False, stream_batch=0, row_max_age=60,
+                 replica_file=None):
         """ Initialize app and store all data.
 
         root: tkinter Tk() instance.
@@ -225,6 +255,36 @@ class RepairApp():
                                               }
                                              }
 
+        page_size: int, number of repairs loaded at once, the next page is
+            loaded when table is scrolled to the bottom; 0 - load all repairs.
+
+        filter_max_age: int, if set - all repairs are loaded once and filters
+            are applied locally until data is older than filter_max_age
+            seconds; 0 - every filter change requires request to server.
+
+        ref_cache: ReferenceCache or None, on-disk cache of references used
+            in creating-editing forms.
+
+        refs_ttl: int, seconds while references used in creating-editing
+            forms are kept in memory without reloading.
+
+        trace: StartupTrace or None, if provided - durations of build and
+            the first table paint are added and trace is written.
+
+        columnar: bool, if True - loaded repairs are kept in compact columnar
+            storage and only visible rows are formatted (for large lists).
+
+        stream_batch: int, if set (and pagination is off) - repairs are
+            fetched by batches of stream_batch rows and shown as they come;
+            sorting is applied when all rows are loaded; 0 - rows are shown
+            after all of them are fetched.
+
+        row_max_age: int, seconds while loaded row is used to fill copy form,
+            older row is requested from server.
+
+        replica_file: str or None, if set - repairs are kept in local SQLite
+            replica synced with server by changes in background; filters
+            are applied by replica.
         """
         self.root = root
         self.conn = connection
@@ -233,8 +293,55 @@ class RepairApp():
         # Filters and other explicitly used info
         self.refs = references
         self._create_refs()
-        self.rows = None
-        self.sort_reversed_index = None  # reverse sorting for the last sorted column
+        self.rows = None  # rows in displayed order
+        self._base_rows = None  # rows in order they were loaded
+        self._loaded_at = None  # time (monotonic) rows were loaded
+        # loaded (or being streamed) rows and {ID: position} in them
+        self._id_rows = ()
+        self._row_ids = {}
+        self.row_max_age = row_max_age
+        self.replica_file = replica_file
+        self.replica = None  # RepairReplica, created with table
+        self._replica_sync = threading.Lock()  # held while sync is running
+        self._sort_index = None
+        # sorting columns [(index in self.rows, reverse)], shift-click on
+        # heading adds column
+        self.sort_columns = []
+        # formatted rows, tag = (Status)
+        self._display = DisplayCache(tag_col=4)
+        # repair list is loaded in background to keep UI responsive;
+        # references and long export-import have their own workers,
+        # so they don't delay refresh
+        self._executor = ThreadPoolExecutor(max_workers=2)
+        self._refs_executor = ThreadPoolExecutor(max_workers=1)
+        self._jobs_executor = ThreadPoolExecutor(max_workers=2)
+        self._refs_callback = None  # form waiting for references
+        self._refresh_id = 0  # id of the latest started refresh
+        # keyset pagination
+        self.page_size = page_size
+        self._filters = None  # filters of the latest refresh
+        self._page_after = None  # (creation time, ID) of the last loaded row
+        self._has_more = False
+        self._page_loading = False
+        # client-side filtering
+        self.filter_max_age = filter_max_age
+        self._filter_engine = None
+        self._comparable = {}  # {column: filter can be applied locally}
+        self.ref_cache = ref_cache
+        self.form_refs = ExpiringValue(self._fetch_form_refs, refs_ttl,
+                                       self._refs_executor)
+        # owner, rc and store history of technics shared by forms
+        self.owner_history = OwnerHistoryCache(self._fetch_owner_history,
+                                               self._refs_executor)
+        self.trace = trace
+        self._load_failed = False  # the latest loading of rows has failed
+        self.columnar = columnar
+        self.stream_batch = stream_batch
+        self._streaming = False  # rows are being appended to the table
+        # network errors reported by connection from any thread
+        self._network_errors = queue.Queue()
+        if self.conn:
+            self.conn.on_network_error = self._network_errors.put
 
     def _add_user_label(self, parent):
         """ Adds user name in bottom right corner. """
@@ -263,6 +370,8 @@ class RepairApp():
         self.owner_box.set('Все')
         self.mfr_box.set('Все')
         self.tech_type_box.set('Все')
+        if self._filter_engine or self.replica:
+            self._apply_local_filters()
 
     def _create_refs(self):
         """ Create references used in filters. """
@@ -274,13 +383,9 @@ class RepairApp():
         self.list_status = ('Все', *self.refs['status_list'])
         self.list_store_types = ('Все', *self.refs.get('TypeStore', ()))
 
-    def _format_float(self, sum_float):
-        return '{:,.2f}'.format(sum_float).replace(',', ' ').replace('.', ',')
-
-    @deco_check_conn
-    def _get_repair_list(self):
-        """ Extract information from filters and get repairs list. """
-        filters = {
+    def _get_filters(self):
+        """ Extract information from filters. """
+        return {
             'created_by': self.refs['People'].get(self.createdby_box.get(), None),
             'rc': None if self.rc_box.get() == 'Все' else self.rc_box.get(),
             'store': self.refs['TypeStore'].get(self.store_box.get(), None),
@@ -289,8 +394,127 @@ class RepairApp():
             'mfr': self.refs['ListMfrs'].get(self.mfr_box.get(), None),
             'tech_type': self.refs['ListTechnicsTypes'].get(self.tech_type_box.get(), None)
         }
+
+    @deco_check_conn
+    def _get_repair_list(self, filters, after=None, load_all=False):
+        """ Get repairs list (or its page after given row if pagination
+            is on). Runs in worker thread, so Tk mustn't be used.
+        """
+        start = monotonic()
         with self.conn as sql:
-            self.rows = sql.get_repair_list(**filters)
+            if load_all or not self.page_size:
+                rows = sql.get_repair_list(**filters)
+            else:
+                rows = sql.get_repair_list_page(**filters,
+                                                page_size=self.page_size,
+                                                after=after)
+        if rows is not None and self.columnar:
+            rows = ColumnarRows(rows)
+        writelog('Repairs loaded: {}'.format(
+                     'error' if rows is None else len(rows)),
+                 level='INFO', action='load_repairs',
+                 duration=round(monotonic() - start, 3))
+        return rows
+
+    @deco_check_conn
+    def _stream_repair_list(self, filters, refresh_id, chunks):
+        """ Put batches of repair list into queue chunks as they are
+            fetched, None is put at the end. Runs in worker thread, so Tk
+            mustn't be used. Fetching stops if newer refresh has started.
+            Returns False if fetching was interrupted by network error.
+        """
+        start = monotonic()
+        count = 0
+        completed = True
+        try:
+            with self.conn as sql:
+                # the first batch is small to be shown at once
+                for rows in sql.iter_repair_list(
+                        **filters, batch_size=self.stream_batch,
+                        first_size=min(self.stream_batch, 200)):
+                    if refresh_id != self._refresh_id:
+                        return
+                    chunks.put(rows)
+                    count += len(rows)
+        except StreamInterruptedError:
+            count = 'error after {}'.format(count)
+            completed = False
+        finally:
+            chunks.put(None)
+        writelog('Repairs streamed: {}'.format(count),
+                 level='INFO', action='load_repairs',
+                 duration=round(monotonic() - start, 3))
+        return completed
+
+    def _select_replica(self, criteria):
+        """ Returns repairs of replica matching criteria, empty replica
+            is synced first. Runs in worker thread, so Tk mustn't be used.
+        """
+        start = monotonic()
+        if self.replica.is_empty():
+            self._sync_replica()
+        try:
+            rows = self.replica.select(criteria)
+        except sqlite3.Error as e:
+            writelog(e, action='select_replica')
+            return None
+        if self.columnar:
+            rows = ColumnarRows(rows)
+        writelog('Repairs selected from replica: {}'.format(len(rows)),
+                 level='INFO', action='select_replica',
+                 duration=round(monotonic() - start, 3))
+        return rows
+
+    @deco_check_conn
+    def _sync_replica(self):
+        """ Apply changes made on server to replica, returns number of
+            changed rows or None if sync failed or another sync is running.
+            Runs in worker thread.
+        """
+        if not self._replica_sync.acquire(blocking=False):
+            return None  # changes will be applied by running sync
+        start = monotonic()
+        try:
+            with self.conn as sql:
+                changed = self.replica.sync(sql.iter_repair_changes(
+                    self.replica.modified_since()))
+        except StreamInterruptedError:
+            # network error has been reported, replica is unchanged
+            changed = None
+        except sqlite3.Error as e:
+            writelog(e, action='sync_replica')
+            changed = None
+        finally:
+            self._replica_sync.release()
+        writelog('Replica synced: {}'.format(
+                     'error' if changed is None else changed),
+                 level='INFO', action='sync_replica',
+                 duration=round(monotonic() - start, 3))
+        return changed
+
+    def _get_loaded_repair(self, repairID):
+        """ Returns values for copy form (see FORM_COLUMNS) taken from
+            loaded rows or None if row is missing or outdated.
+        """
+        if (not self._row_ids or self._loaded_at is None
+                or monotonic() - self._loaded_at > self.row_max_age):
+            return None
+        columns = self.table['columns']
+        try:
+            positions = [columns.index(column) for column in FORM_COLUMNS]
+        except ValueError:
+            return None
+        i = self._row_ids.get(repairID)
+        if i is None and isinstance(repairID, str) and repairID.isdigit():
+            # values shown in table may be converted to str by Tk
+            i = self._row_ids.get(int(repairID))
+        if i is None:
+            return None
+        row = self._id_rows[i]
+        values = ['' if row[pos] is None else row[pos] for pos in positions]
+        units = FORM_COLUMNS.index('Ед. изм.')
+        values[units] = values[units] or 'не указано'
+        return tuple(values)
 
     def _init_table(self, parent):
         """ Creates treeview. """
@@ -333,21 +557,90 @@ class RepairApp():
         scrolltable_v.pack(side=tk.RIGHT, fill=tk.Y)
 
     @deco_check_conn
-    def _load_refs(self):
-        """ Load references for creating-editing repairs. """
+    def _fetch_form_refs(self):
+        """ Load references for creating-editing repairs from server.
+            May run in worker thread, so Tk mustn't be used.
+        """
         with self.conn as sql:
-            tech_info = sql.get_technics_info()
+            if self.ref_cache:
+                # cheap check, unchanged sets are read from disk
+                versions = sql.get_references_versions() or {}
+                get = lambda name, fetch: self.ref_cache.get(
+                    name, versions.get(name), fetch)
+            else:
+                get = lambda name, fetch: fetch()
+            tech_info = get('technics_info', sql.get_technics_info)
+            measure_units = get('measure_units', sql.get_measure_units)
+            objects = get('objects', sql.get_objects)
+            if any(rows is None for rows in (tech_info, measure_units,
+                                             objects)):
+                # network error, incomplete references aren't kept
+                raise OfflineError()
             tech_info = dict((data[0], data[1:]) for data in tech_info)
-            measure_units = sql.get_measure_units()
             measure_units = dict((data[0], data[1]) for data in measure_units)
-            objects = sql.get_objects()
             objects = dict((data[1:], data[0]) for data in objects)
+        return {'tech_info': tech_info,
+                'measure_units': measure_units,
+                'objects': objects,
+                # index of serial numbers isn't built in Tk thread
+                'sn_index': SubstringIndex(tech_info.keys())}
+
+    @deco_check_conn
+    def _fetch_owner_history(self, sn):
+        """ Load owner history of technics (runs in worker thread). """
+        with self.conn as sql:
+            return sql.get_object_owner_history(sn)
+
+    def _load_refs(self, callback):
+        """ Call callback(options) with references for creating-editing
+            repairs (kept in memory). If they aren't loaded yet, Tk isn't
+            blocked while they are loaded in background. callback isn't
+            called if references can't be loaded (message is shown).
+        """
+        if self._refs_callback is not None:
+            return  # another form is waiting for references
+        self._refs_callback = callback
+        self._poll_refs()
+
+    def _poll_refs(self):
+        """ Wait for references without blocking Tk (see _load_refs). """
+        if not self.form_refs.ready():
+            self.root.after(100, self._poll_refs)
+            return
+        callback, self._refs_callback = self._refs_callback, None
+        try:
+            refs = self.form_refs.get()
+        except OfflineError:
+            self._show_network_failure('Не удалось загрузить справочники.')
+            return
         options = {'conn': self.conn,
                    'userID': self.UserID,
-                   'tech_info': tech_info,
-                   'measure_units': measure_units,
-                   'objects': objects}
-        return options
+                   'owner_history': self.owner_history}
+        options.update(refs)
+        callback(options)
+
+    def _get_current_repair(self, repairID):
+        """ Returns values for copy form taken from loaded rows or server,
+            None if they can't be got (message is shown).
+        """
+        current_repair = self._get_loaded_repair(repairID)
+        if current_repair is not None:
+            return current_repair
+        with self.conn as sql:
+            rows = sql.get_current_repair(repairID)
+        if rows is None:
+            self._show_network_failure('Не удалось загрузить данные ремонта.')
+            return None
+        if not rows:
+            messagebox.showinfo('Создание копии',
+                                'Ремонт не найден (возможно, он удалён)',
+                                parent=self.root)
+            return None
+        return rows[0]
+
+    def _reload_refs(self):
+        """ Reload references for creating-editing repairs. """
+        self.form_refs.invalidate()
 
     def _make_buttons_frame(self):
         """ Bottom frame with status, version, user info etc.
@@ -445,11 +738,12 @@ class RepairApp():
             'Кол-во единиц': 14, 'Ед. изм.': 8}
         #self.headings=('a', 'bb', 'cccc')  # for debug
 
-        self.table = ttk.Treeview(bottom_main, show='headings',
-                                      selectmode='browse',
-                                      style='HeaderStyle.Treeview'
-                                      )
+        self.table = VirtualTreeview(bottom_main, show='headings',
+                                     selectmode='browse',
+                                     style='HeaderStyle.Treeview'
+                                     )
         self._init_table(bottom_main)
+        self.table.on_near_end = self._load_next_page
         self.table.pack(expand=True, fill=tk.BOTH)
         head = self.table["columns"]
         msg = 'Heading order must be reviewed. Wrong heading: '
@@ -473,6 +767,10 @@ class RepairApp():
         tech_type_label.pack(side=tk.LEFT)
         self.tech_type_box.pack(side=tk.LEFT, padx=10)
         row2_cf.pack(side=tk.TOP, fill=tk.X, padx=20, pady=5)
+        for box in (self.createdby_box, self.rc_box, self.store_box,
+                    self.status_box, self.owner_box, self.mfr_box,
+                    self.tech_type_box):
+            box.bind('<<ComboboxSelected>>', self._apply_local_filters)
         top_main.pack(side=tk.TOP, fill=tk.X, padx=5, pady=5)
         bottom_main.pack(side=tk.BOTTOM, fill=tk.BOTH, expand=True, padx=5, pady=5)
 
@@ -493,8 +791,17 @@ class RepairApp():
         hm = tk.Menu(help_menu, tearoff=0)
         help_menu['menu'] = hm
 
+        fm.add_command(label='Загрузить все записи',
+                       command=self._load_all)
+        fm.add_command(label='Обновить справочники',
+                       command=self._reload_refs)
+        fm.add_command(label='Импорт ремонтов...',
+                       command=self._popup_import_form)
+        fm.add_command(label='Экспорт списка...',
+                       command=self._popup_export_form)
         fm.add_command(label='Выход', underline=0,
                        command=self.root.quit_with_confirmation)
+        hm.add_command(label='Диагностика', command=self._popup_diagnostics)
         hm.add_command(label='О программе...', underline=0,
                        command=self._popup_about)
         return main_menu
@@ -503,6 +810,12 @@ class RepairApp():
         """ Bottom frame with status, version, user info etc.
         """
         bottom_frame = tk.Frame(self.root)
+        self.status_label = tk.Label(bottom_frame, text='', font=('Arial', 8))
+        self.status_label.pack(side=tk.LEFT, anchor=tk.SW, padx=2)
+        # packed while server is unreachable
+        self.offline_label = tk.Label(bottom_frame, fg='red',
+                                      text='Нет связи с сервером',
+                                      font=('Arial', 8))
         self._add_user_label(bottom_frame)
         return bottom_frame
 
@@ -512,12 +825,61 @@ class RepairApp():
                              title='Ремонт техники v. ' + __version__,
                              width=400, height=140)
 
+    def _popup_export_form(self, event=None):
+        """ Ask file name and raise frame exporting repair list
+            with current filters.
+        """
+        if not self.conn:
+            return
+        fname = filedialog.asksaveasfilename(
+            parent=self.root, title='Экспорт списка ремонтов',
+            defaultextension='.xlsx', initialfile='Ремонты.xlsx',
+            filetypes=(('Excel', '*.xlsx'), ('CSV', '*.csv')))
+        if not fname:
+            return
+        self._raise_Toplevel(frame=ExportFrame,
+                             title='Экспорт списка ремонтов',
+                             width=500, height=120,
+                             options={'conn': self.conn,
+                                      'fname': fname,
+                                      'filters': self._get_filters(),
+                                      'headings': list(self.headings),
+                                      'executor': self._jobs_executor})
+
+    def _popup_import_form(self, event=None):
+        """ Raise frame to import repairs from file. """
+        self._load_refs(self._raise_import_form)
+
+    def _raise_import_form(self, options):
+        del options['objects'], options['owner_history'], options['sn_index']
+        options['executor'] = self._jobs_executor
+        self._raise_Toplevel(frame=ImportFrame,
+                             title='Импорт ремонтов',
+                             width=500, height=200,
+                             refresh_after=True,
+                             options=options)
+
+    def _popup_diagnostics(self, event=None):
+        """ Raise frame with metrics of db procedures. """
+        if not self.conn:
+            return
+        self._raise_Toplevel(frame=DiagnosticsFrame,
+                             title='Диагностика',
+                             width=900, height=400,
+                             options={'conn': self.conn})
+
     def _popup_create_copy_form(self, event=None):
-        curRow = self.table.focus()
+        curRow = self.table.focused_row()
         if not curRow:
             return
-        options = self._load_refs()
-        options['current_repairID'] = self.table.item(curRow).get('values')[0]
+        self._load_refs(partial(self._raise_create_copy_form, curRow[0]))
+
+    def _raise_create_copy_form(self, repairID, options):
+        current_repair = self._get_current_repair(repairID)
+        if current_repair is None:
+            return
+        options['current_repairID'] = repairID
+        options['current_repair'] = current_repair
         self._raise_Toplevel(frame=CreateCopyFrame,
                              title='Данные о ремонте',
                              width=800, height=400,
@@ -526,7 +888,9 @@ class RepairApp():
                              options=options)
 
     def _popup_create_form(self, event=None):
-        options = self._load_refs()
+        self._load_refs(self._raise_create_form)
+
+    def _raise_create_form(self, options):
         self._raise_Toplevel(frame=CreateFrame,
                              title='Данные о ремонте',
                              width=800, height=400,
@@ -560,22 +924,343 @@ class RepairApp():
             self.root.wait_window(newlevel)
             self._refresh()
 
+    def _apply_local_filters(self, event=None):
+        """ Filter rows loaded by client-side filter engine (or replica).
+            Reload rows from server if they are outdated.
+        """
+        if self.replica:
+            self._refresh_id += 1
+            self._show_replica()
+            return
+        if not self.filter_max_age:
+            return
+        if (self._filter_engine is None
+                or self._filter_engine.is_stale(self.filter_max_age)):
+            self._refresh()
+            return
+        criteria = self._get_local_criteria()
+        if not all(map(self._is_comparable, criteria)):
+            # some filters can't be applied locally, ask server
+            self._refresh_id += 1
+            self._set_busy(True)
+            future = self._executor.submit(self._get_repair_list,
+                                           self._get_filters(),
+                                           load_all=True)
+            self._poll_refresh(future, self._refresh_id,
+                               partial(self._on_rows_loaded,
+                                       paginated=False))
+            return
+        self._set_base_rows(self._filter_engine.select(criteria))
+
+    def _filter_boxes(self):
+        """ Returns {column name: combobox of filter by this column}. """
+        return {'Создал': self.createdby_box, 'РЦ': self.rc_box,
+                'Склад': self.store_box, 'Статус': self.status_box,
+                'Собственник': self.owner_box,
+                'Производитель': self.mfr_box,
+                'Вид техники': self.tech_type_box}
+
+    def _get_local_criteria(self):
+        """ Column values used by client-side filter engine
+            (see _is_comparable).
+        """
+        return {column: box.get() for column, box
+                in self._filter_boxes().items() if box.get() != 'Все'}
+
+    def _is_comparable(self, column):
+        """ Check if captions of filter match values of column in table,
+            i.e. every value of loaded rows is one of filter captions.
+            Result is kept until rows are loaded again.
+        """
+        if column not in self._comparable:
+            captions = set(self._filter_boxes()[column]['values'])
+            values = self._filter_engine.values(column) - {None, ''}
+            self._comparable[column] = values <= captions
+            if not self._comparable[column]:
+                writelog('Filter {} is applied by server: values of table '
+                         "don't match filter".format(column),
+                         level='WARNING', action='local_filters')
+        return self._comparable[column]
+
+    def _load_all(self):
+        """ Load all repairs matching the latest filters at once. """
+        if self._filters is None or self.replica:
+            # replica shows all repairs matching filters
+            return
+        self._refresh_id += 1
+        if self.stream_batch:
+            self._start_stream(self._filters)
+            return
+        future = self._executor.submit(self._get_repair_list, self._filters,
+                                       load_all=True)
+        self._set_busy(True)
+        self._poll_refresh(future, self._refresh_id,
+                           partial(self._on_rows_loaded, paginated=False))
+
+    def _load_next_page(self):
+        """ Load the next page of repairs in background. """
+        if not self._has_more or self._page_loading:
+            return
+        self._page_loading = True
+        future = self._executor.submit(self._get_repair_list, self._filters,
+                                       after=self._page_after)
+        self._set_busy(True)
+        self._poll_refresh(future, self._refresh_id,
+                           partial(self._on_rows_loaded, append=True))
+
+    def _on_filter_base_loaded(self, rows):
+        """ Build client-side filter engine over all repairs. """
+        if rows is None:
+            # loading failed, the old engine (if any) stays stale,
+            # so the next filter change tries to load rows again
+            return
+        self._filter_engine = RepairFilter(rows, self.table['columns'])
+        self._comparable = {}
+        self._loaded_at = self._filter_engine.loaded_at
+        self._display.clear()
+        self._apply_local_filters()
+
+    def _on_replica_loaded(self, rows, sync=False):
+        """ Show rows of replica and start its sync if needed. """
+        self._on_rows_loaded(rows, paginated=False)
+        # None until replica is synced in this session, so rows of file
+        # (may be outdated) aren't taken by forms
+        self._loaded_at = self.replica.synced_at
+        if sync:
+            self.status_label.configure(text='Синхронизация...')
+            future = self._executor.submit(self._sync_replica)
+            self._poll_refresh(future, self._refresh_id,
+                               self._on_replica_synced)
+
+    def _on_replica_synced(self, changed):
+        """ Show rows of replica again if changes have come. """
+        if changed:
+            self._show_replica()
+        else:
+            self._loaded_at = self.replica.synced_at
+
+    def _on_rows_loaded(self, rows, append=False, paginated=True):
+        """ Show loaded rows.
+
+            append: bool, if True - rows are added to already loaded ones.
+            paginated: bool, if False - all rows are loaded at once.
+        """
+        if not append:
+            self._load_failed = rows is None
+        if rows is None:  # loading failed
+            rows = []
+        paginated = paginated and bool(self.page_size)
+        self._has_more = paginated and len(rows) == self.page_size
+        if paginated and rows:
+            self._page_after = (rows[-1][2], rows[-1][0])
+        if not append:
+            self._display.clear()
+            self._loaded_at = monotonic()
+        if append:
+            # columnar storage is extended in place instead of rebuilding
+            self._base_rows.extend(rows)
+            rows = self._base_rows
+        self._set_base_rows(rows)
+
+    def _poll_network_errors(self):
+        """ Show one message for all network errors reported since the last
+            check (errors may come from worker threads).
+            While server is unreachable (circuit breaker is open) only
+            offline indicator is shown.
+        """
+        errors = 0
+        while True:
+            try:
+                self._network_errors.get_nowait()
+            except queue.Empty:
+                break
+            errors += 1
+        offline = bool(self.conn) and self.conn.breaker.is_open
+        if offline != bool(self.offline_label.winfo_ismapped()):
+            if offline:
+                self.offline_label.pack(side=tk.LEFT, anchor=tk.SW, padx=2)
+            else:
+                self.offline_label.pack_forget()
+        if errors and not offline:
+            messagebox.showerror(
+                'Ошибка cети',
+                'Возникла общая ошибка сети.\nПовторите попытку позже',
+                parent=self.root
+            )
+        self.root.after(300, self._poll_network_errors)
+
+    def _show_network_failure(self, message):
+        """ Show one message about action failed because of network
+            (general messages about errors reported for it are dropped).
+        """
+        while True:
+            try:
+                self._network_errors.get_nowait()
+            except queue.Empty:
+                break
+        messagebox.showerror('Ошибка cети',
+                             message + '\nПовторите попытку позже',
+                             parent=self.root)
+
+    def _poll_stream(self, future, refresh_id, chunks, rows, shown):
+        """ Append streamed batches to the table, at most for 50 ms
+            at once to keep UI responsive. When all batches are received
+            rows are stored and sorted as usual.
+
+            rows - list of received rows;
+            shown - list of their formatted (values, tags).
+        """
+        if refresh_id != self._refresh_id:
+            return
+        deadline = monotonic() + 0.05
+        added = finished = False
+        while not finished and monotonic() < deadline:
+            try:
+                batch = chunks.get_nowait()
+            except queue.Empty:
+                break
+            if batch is None:
+                finished = True
+                break
+            self._row_ids.update(zip((row[0] for row in batch),
+                                     range(len(rows), len(rows) + len(batch))))
+            rows.extend(batch)
+            shown.extend(self._display.get(batch))
+            added = True
+        if finished:
+            self._streaming = False
+            self._set_busy(False)
+            # exception of worker is raised here
+            self._load_failed = not future.result() and not rows
+            self._set_base_rows(ColumnarRows(rows) if self.columnar
+                                else rows)
+            return
+        if added:
+            self.rows = rows
+            self.table.set_rows(shown)
+            self._mark_first_paint()
+        self.status_label.configure(
+            text='Загрузка… строк: {}'.format(len(rows)))
+        self.root.after(50, self._poll_stream, future, refresh_id, chunks,
+                        rows, shown)
+
+    def _poll_refresh(self, future, refresh_id, on_done):
+        """ Check if background refresh is finished and pass its result
+            to on_done. Result of outdated refresh (newer one has started)
+            is dropped.
+        """
+        if refresh_id != self._refresh_id:
+            return
+        if not future.done():
+            self.root.after(50, self._poll_refresh, future, refresh_id,
+                            on_done)
+            return
+        self._set_busy(False)
+        self._page_loading = False
+        on_done(future.result())
+
     def _refresh(self):
-        """ Refresh repairs information. """
-        self._get_repair_list()
-        self._show_rows(self.rows)
+        """ Refresh repairs information in background. """
+        self._refresh_id += 1
+        self._page_after = None
+        self._page_loading = False
+        self._streaming = False
+        self._set_busy(True)
+        if self.replica:
+            # filters are applied by replica, only changes are loaded
+            self._filters = self._get_filters()
+            self._show_replica(sync=True)
+            return
+        if self.filter_max_age:
+            # load all repairs, filters are applied locally
+            self._filters = dict.fromkeys(self._get_filters())
+            future = self._executor.submit(self._get_repair_list,
+                                           self._filters, load_all=True)
+            self._poll_refresh(future, self._refresh_id,
+                               self._on_filter_base_loaded)
+            return
+        self._filters = self._get_filters()
+        if self.stream_batch and not self.page_size:
+            self._start_stream(self._filters)
+            return
+        future = self._executor.submit(self._get_repair_list, self._filters)
+        self._poll_refresh(future, self._refresh_id, self._on_rows_loaded)
+
+    def _show_replica(self, sync=False):
+        """ Show repairs of replica matching filters (the latest refresh
+            id is used). If sync - replica is synced with server
+            in background and shown again if anything has changed.
+        """
+        self._set_busy(True)
+        future = self._executor.submit(self._select_replica,
+                                       self._get_local_criteria())
+        self._poll_refresh(future, self._refresh_id,
+                           partial(self._on_replica_loaded, sync=sync))
+
+    def _start_stream(self, filters):
+        """ Load repairs in background showing them as they come
+            (the latest refresh id is used).
+        """
+        self._set_busy(True)
+        self._streaming = True
+        self._has_more = False
+        self._loaded_at = monotonic()
+        self._display.clear()
+        # rows shown before aren't used by forms, repairs are looked up
+        # in streamed rows
+        rows = []
+        self._id_rows, self._row_ids = rows, {}
+        chunks = queue.Queue()
+        future = self._executor.submit(self._stream_repair_list, filters,
+                                       self._refresh_id, chunks)
+        self._poll_stream(future, self._refresh_id, chunks, rows, [])
+
+    def _set_base_rows(self, rows):
+        """ Store loaded rows and show them sorted by current columns. """
+        # columnar storage and its views are kept as is
+        self._base_rows = rows if hasattr(rows, 'view') else list(rows)
+        self._sort_index = SortIndex(self._base_rows)
+        self._id_rows = self._base_rows
+        self._row_ids = row_ids(self._base_rows)
+        self._show_sorted()
+
+    def _set_busy(self, busy):
+        """ Show or hide busy indicator. """
+        self.status_label.configure(text='Загрузка...' if busy else '')
+        self.root.configure(cursor='watch' if busy else '')
 
     def _show_rows(self, rows):
         """ Refresh table with new rows. """
-        self.table.delete(*self.table.get_children())
-        if not rows:
-            return
-        for row in rows:
-            # tag = (Status)
-            self.table.insert('', tk.END,
-                values=tuple(map(lambda val: self._format_float(val)
-                if isinstance(val, Decimal) else '' if val is None else val, row)),
-                tags=(row[4],))
+        if hasattr(rows, 'column'):  # columnar storage
+            self.table.set_rows(LazyDisplay(rows, tag_col=4))
+        else:
+            self.table.set_rows(self._display.get(rows or ()))
+        self._mark_first_paint()
+
+    def _mark_first_paint(self):
+        """ Add time of the first shown rows to trace and write it. """
+        if self.trace:
+            self.root.update_idletasks()
+            self.trace.mark('first_paint')
+            try:
+                # empty table is shown if the first loading has failed
+                self.trace.write(
+                    outcome='load_error' if self._load_failed else 'ok')
+            except OSError as e:
+                writelog(e)
+            self.trace = None
+
+    def _show_sorted(self):
+        """ Reorder rows by sort columns using cached permutations. """
+        if self.sort_columns:
+            order = self._sort_index.order(self.sort_columns)
+            if hasattr(self._base_rows, 'view'):
+                self.rows = self._base_rows.view(order)
+            else:
+                self.rows = [self._base_rows[i] for i in order]
+        else:
+            self.rows = self._base_rows
+        self._show_rows(self.rows)
 
     def _sort(self, event):
         if self.table.identify_region(event.x, event.y) == 'heading' and self.rows:
@@ -583,11 +1268,33 @@ class RepairApp():
             disp_col = int(self.table.identify_column(event.x)[1:]) - 1
             # determine index of this column in self.rows
             sort_col = self.table["columns"].index(self.table["displaycolumns"][disp_col])
-            self.rows.sort(key=lambda x: (x[sort_col] is None, x[sort_col]),
-                           reverse=self.sort_reversed_index == sort_col)
-            # store index of last sorted column if sort wasn't reversed
-            self.sort_reversed_index = None if self.sort_reversed_index==sort_col else sort_col
-            self._show_rows(self.rows)
+            directions = dict(self.sort_columns)
+            if event.state & 0x0001 and self.sort_columns:
+                # shift-click: add column or change its direction
+                if sort_col in directions:
+                    self.sort_columns = [(col, not rev if col == sort_col
+                                          else rev)
+                                         for col, rev in self.sort_columns]
+                else:
+                    self.sort_columns.append((sort_col, False))
+            else:
+                # the second click on the same column reverses sorting
+                self.sort_columns = [(sort_col,
+                                      self.sort_columns == [(sort_col, False)])]
+            self._update_headings()
+            # while rows are streamed sorting is applied at the end
+            if not self._streaming:
+                self._show_sorted()
+
+    def _update_headings(self):
+        """ Show sorting direction (and order for several columns). """
+        columns = self.table["columns"]
+        marks = {}
+        for n, (col, reverse) in enumerate(self.sort_columns, 1):
+            marks[col] = (' ▼' if reverse else ' ▲') + (
+                str(n) if len(self.sort_columns) > 1 else '')
+        for i, head in enumerate(columns):
+            self.table.heading(head, text=head + marks.get(i, ''))
 
     def build(self):
         """ Building app structure.
@@ -601,6 +1308,14 @@ class RepairApp():
         frame_statusbar.pack(side=tk.BOTTOM, fill=tk.X)
         frame_buttons.pack(side=tk.BOTTOM, fill=tk.X)
         frame_main.pack(side=tk.TOP, fill=tk.BOTH, expand=True, padx=10, pady=5)
+        if self.replica_file:
+            try:
+                # columns of replica are columns of table
+                self.replica = RepairReplica(self.replica_file,
+                                             self.table['columns'])
+            except sqlite3.Error as e:
+                # repairs are loaded from server
+                writelog(e, action='open_replica')
 
     def mainloop(self):
         """ Redirection to root.mainloop.
@@ -619,9 +1334,20 @@ class RepairApp():
         except Exception as e:
             self.root.destroy()
             raise
+        if self.trace:
+            self.trace.mark('build')
         self._clear_filters()
+        self._poll_network_errors()
         self.root.after(200, self._refresh)
-        self.mainloop()
+        # load references for forms while user looks through the list
+        if self.conn:
+            self.root.after(1000, self.form_refs.prefetch)
+        try:
+            self.mainloop()
+        finally:
+            for executor in (self._executor, self._refs_executor,
+                             self._jobs_executor):
+                executor.shutdown(wait=False)
 
 
 class AboutFrame(tk.Frame):
@@ -664,8 +1390,237 @@ class AboutFrame(tk.Frame):
         self.pack(fill=tk.BOTH, expand=True, pady=5)
 
 
+class DiagnosticsFrame(tk.Frame):
+    """ Creates a frame with latency and volume metrics of db procedures
+        and statistics of connection pool.
+    """
+    def __init__(self, parent, conn):
+        super().__init__(parent)
+        self.conn = conn
+
+        self.report_text = tk.Text(self, font=('Courier New', 9),
+                                   width=110, height=20, wrap=tk.NONE)
+        self.bottom = tk.Frame(self)
+        self.bt_refresh = ttk.Button(self.bottom, text="Обновить", width=10,
+                                     command=self._show_report)
+        self.bt_save = ttk.Button(self.bottom, text="Сохранить в файл", width=18,
+                                  command=self._save)
+        self.bt_close = ttk.Button(self.bottom, text="Закрыть", width=10,
+                                   command=parent.destroy)
+        self._show_report()
+        self.pack_all()
+
+    def _save(self):
+        """ Append metrics to METRICS_FILE in working directory. """
+        fname = os.path.join(os.getcwd(), METRICS_FILE)
+        try:
+            self.conn.metrics.dump(fname, pool=self.conn.pool_stats())
+        except OSError as e:
+            writelog(e)
+            messagebox.showerror('Ошибка', 'Не удалось сохранить файл\n'
+                                 + fname, parent=self)
+            return
+        messagebox.showinfo('Диагностика', 'Данные сохранены в файл\n'
+                            + fname, parent=self)
+
+    def _show_report(self):
+        pool = self.conn.pool_stats()
+        report = (self.conn.metrics.report() + '\n\nПул соединений: '
+                  + ', '.join('{} = {}'.format(key, round(value, 3))
+                              for key, value in pool.items()))
+        self.report_text.configure(state=tk.NORMAL)
+        self.report_text.delete('1.0', tk.END)
+        self.report_text.insert(tk.END, report)
+        self.report_text.configure(state=tk.DISABLED)
+
+    def pack_all(self):
+        self.bt_close.pack(side=tk.RIGHT, padx=5)
+        self.bt_save.pack(side=tk.RIGHT, padx=5)
+        self.bt_refresh.pack(side=tk.RIGHT, padx=5)
+        self.bottom.pack(side=tk.BOTTOM, fill=tk.X, pady=5)
+        self.report_text.pack(side=tk.TOP, fill=tk.BOTH, expand=True,
+                              padx=10, pady=5)
+        self.pack(fill=tk.BOTH, expand=True, pady=5)
+
+
+class ExportFrame(tk.Frame):
+    """ Creates a frame showing progress of export of repair list.
+        Export runs in executor, rows are fetched and written by batches.
+    """
+    def __init__(self, parent, conn, fname, filters, headings, executor):
+        super().__init__(parent)
+        self.conn = conn
+        self.fname = fname
+        self.report = ExportReport()
+        self.cancel = threading.Event()
+
+        self.file_label = tk.Label(self, text=fname, anchor=tk.W, width=60)
+        self.progress_label = tk.Label(self, text='', anchor=tk.W)
+        self.bottom = tk.Frame(self)
+        self.bt_cancel = ttk.Button(self.bottom, text='Отмена', width=10,
+                                    command=self.cancel.set)
+        self.bt_close = ttk.Button(self.bottom, text='Закрыть', width=10,
+                                   command=parent.destroy)
+        # running export stops if window is closed (file isn't created)
+        self.bind('<Destroy>', lambda event: self.cancel.set())
+        self.pack_all()
+        self._poll(executor.submit(self._export, filters, headings))
+
+    def _export(self, filters, headings):
+        """ Runs in worker thread, so Tk mustn't be used. """
+        start = monotonic()
+        try:
+            with self.conn as sql:
+                export_rows(sql.iter_repair_list(**filters), self.fname,
+                            headings, report=self.report, cancel=self.cancel)
+        except StreamInterruptedError:
+            self.report.error = 'ошибка при обращении к серверу'
+        except OSError as e:
+            writelog(e, action='export')
+            self.report.error = 'не удалось записать файл'
+        writelog('Repairs exported: {}'.format(self.report.rows),
+                 level='INFO', action='export_repairs',
+                 duration=round(monotonic() - start, 3))
+
+    def _poll(self, future):
+        if not self.winfo_exists():
+            return
+        self.progress_label.configure(
+            text='Выгружено строк: {}'.format(self.report.rows))
+        if not future.done():
+            self.after(200, self._poll, future)
+            return
+        self.bt_cancel.configure(state='disabled')
+        future.result()
+        messagebox.showinfo('Экспорт списка ремонтов',
+                            self.report.summary(), parent=self)
+
+    def pack_all(self):
+        self.file_label.pack(side=tk.TOP, fill=tk.X, padx=10, pady=5)
+        self.progress_label.pack(side=tk.TOP, fill=tk.X, padx=10)
+        self.bt_cancel.pack(side=tk.LEFT, padx=5)
+        self.bt_close.pack(side=tk.RIGHT, padx=5)
+        self.bottom.pack(side=tk.BOTTOM, fill=tk.X, padx=5, pady=10)
+        self.pack(fill=tk.BOTH, expand=True, pady=5)
+
+
+class ImportFrame(tk.Frame):
+    """ Creates a frame to import repairs from CSV/XLSX file.
+        Import runs in executor, progress is checked periodically.
+    """
+    def __init__(self, parent, conn, userID, tech_info, measure_units,
+                 executor):
+        super().__init__(parent)
+        self.parent = parent
+        self.conn = conn
+        self.UserID = userID
+        self.tech_info = tech_info
+        self.measure_units = measure_units
+        self.executor = executor
+        self.fname = None
+        self.report = None
+        self.cancel = threading.Event()
+
+        self.file_label = tk.Label(self, text='Файл не выбран', anchor=tk.W,
+                                   width=60)
+        self.bt_choose = ttk.Button(self, text='Выбрать файл', width=15,
+                                    command=self._choose_file)
+        self.is_fixed = tk.IntVar()
+        self.fixed_check = ttk.Checkbutton(
+            self, variable=self.is_fixed,
+            text='Зафиксировать (без возможности редактировать в будущем)')
+        self.progress_label = tk.Label(self, text='', anchor=tk.W,
+                                       justify=tk.LEFT)
+        self.bottom = tk.Frame(self)
+        self.bt_import = ttk.Button(self.bottom, text='Импортировать',
+                                    width=15, command=self._start,
+                                    style='ButtonGreen.TButton',
+                                    state='disabled')
+        self.bt_cancel = ttk.Button(self.bottom, text='Отмена', width=10,
+                                    command=self.cancel.set,
+                                    state='disabled')
+        self.bt_close = ttk.Button(self.bottom, text='Закрыть', width=10,
+                                   command=parent.destroy)
+        # running import stops if window is closed (created repairs are kept)
+        self.bind('<Destroy>', lambda event: self.cancel.set())
+        self.pack_all()
+
+    def _choose_file(self):
+        fname = filedialog.askopenfilename(
+            parent=self, title='Файл с ремонтами',
+            filetypes=(('Excel, CSV', '*.xlsx *.csv'), ('Все файлы', '*.*')))
+        if fname:
+            self.fname = fname
+            self.file_label.configure(text=fname)
+            self.bt_import.configure(state='normal')
+
+    def _import(self, fname, statusID):
+        """ Runs in worker thread, so Tk mustn't be used. """
+        try:
+            return import_repairs(
+                read_rows(fname), self.conn, userID=self.UserID,
+                statusID=statusID, tech_info=self.tech_info,
+                measure_units=self.measure_units, report=self.report, cancel=self.cancel,
+                request_key=(str(uuid4()) if self.conn.idempotency_keys
+                             else None))
+        except RepairImportError as e:
+            self.report.error = e.message
+        except OSError as e:
+            writelog(e, action='import')
+            self.report.error = 'не удалось прочитать файл'
+        return self.report
+
+    def _poll(self, future):
+        if not self.winfo_exists():
+            return
+        report = self.report
+        self.progress_label.configure(
+            text='Обработано строк: {}, создано: {}, ошибок: {}'.format(
+                report.total, report.created, len(report.errors)))
+        if not future.done():
+            self.after(200, self._poll, future)
+            return
+        self.bt_cancel.configure(state='disabled')
+        self.bt_choose.configure(state='normal')
+        future.result()
+        message = report.summary()
+        if report.errors:
+            errors_fname = os.path.splitext(self.fname)[0] + '_ошибки.csv'
+            try:
+                report.save(errors_fname)
+                message += '\n\nОтчёт об ошибках:\n' + errors_fname
+            except OSError as e:
+                writelog(e, action='import_report')
+                message += '\n\nНе удалось сохранить отчёт об ошибках'
+        messagebox.showinfo('Импорт ремонтов', message, parent=self)
+
+    def _start(self):
+        self.cancel.clear()
+        self.report = ImportReport()
+        for bt in (self.bt_import, self.bt_choose):
+            bt.configure(state='disabled')
+        self.bt_cancel.configure(state='normal')
+        self._poll(self.executor.submit(self._import, self.fname,
+                                        2 if self.is_fixed.get() else 1))
+
+    def pack_all(self):
+        self.file_label.grid(row=0, column=0, padx=10, pady=5, sticky=tk.W)
+        self.bt_choose.grid(row=0, column=1, padx=10, pady=5)
+        self.fixed_check.grid(row=1, column=0, columnspan=2, padx=10,
+                              sticky=tk.W)
+        self.progress_label.grid(row=2, column=0, columnspan=2, padx=10,
+                                 pady=5, sticky=tk.W)
+        self.bt_import.pack(side=tk.LEFT, padx=5)
+        self.bt_cancel.pack(side=tk.LEFT, padx=5)
+        self.bt_close.pack(side=tk.RIGHT, padx=5)
+        self.bottom.grid(row=3, column=0, columnspan=2, padx=5, pady=10,
+                         sticky=tk.EW)
+        self.pack(fill=tk.BOTH, expand=True, pady=5)
+
+
 class CreateFrame(tk.Frame):
-    def __init__(self, parent, conn, userID, tech_info, measure_units, objects):
+    def __init__(self, parent, conn, userID, tech_info, measure_units, objects,
+                 owner_history=None, sn_index=None):
         # hide until all frames have been created
         parent.withdraw()
         super().__init__(parent)
@@ -676,9 +1631,15 @@ class CreateFrame(tk.Frame):
         self.measure_units = measure_units
         self.measure_units_list = (*self.measure_units,)
         self.objects = objects
+        # OwnerHistoryCache or None (owner is requested on every date)
+        self.owner_history = owner_history
         self.allowed_objects = None
         # parameter to control SN correctness to prevent _create execution
         self.is_sn_correct = False
+        # the same key for all attempts to save this form, so server
+        # creates repair once even if request is repeated
+        self.request_key = (str(uuid4()) if conn.idempotency_keys
+                            else None)
 
         frame_name = self._get_frame_name()
         main_label = tk.Label(self, text=frame_name, width=20,
@@ -689,8 +1650,10 @@ class CreateFrame(tk.Frame):
                               anchor=tk.E, font=('Arial', 8, 'bold'))
         sn_label.grid(row=1, column=0, pady=5, padx=20, sticky=tk.E)
 
-        self.sn_entry = AutocompleteEntry(list(self.tech_info.keys()),
-                                     self, width=30)
+        # sn_index - SubstringIndex of serial numbers built in background
+        self.sn_entry = AutocompleteEntry(
+            sn_index.items if sn_index else list(self.tech_info.keys()),
+            self, width=30, index=sn_index)
         self.sn_entry.bind("<FocusOut>", self._check_SN)
         self.sn_entry.grid(row=1, column=1, pady=5, padx=5)
 
@@ -863,6 +1826,9 @@ class CreateFrame(tk.Frame):
                 obj.set(val)
             self.date_broken_entry.configure(state='readonly')
             self.is_sn_correct = True
+            if self.owner_history:
+                # date is chosen next, its owner is found locally
+                self.owner_history.prefetch(sn)
         except KeyError:
             messagebox.showinfo(
                 'Серийный номер',
@@ -902,20 +1868,10 @@ class CreateFrame(tk.Frame):
             self.date_repair_end.set('')
 
     def _convert_date(self, date_in, output=None):
-        """ Take date_in and convert it into output format.
-            If output is None datetime object is returned.
-
-            date: str in format '%d[./]%m[./]%y' or '%d[./]%m[./]%Y'.
-            output: str or None, output format.
+        """ Take date_in and convert it into output format
+            (see repair_rules.convert_date).
         """
-        date_in = date_in.replace('/', '.')
-        try:
-            dat = datetime.strptime(date_in, '%d.%m.%y')
-        except ValueError:
-            dat = datetime.strptime(date_in, '%d.%m.%Y')
-        if output:
-            return dat.strftime(output)
-        return dat
+        return convert_date(date_in, output)
 
     def _create(self, is_fixed=False):
         """ Create repair according to filled fields.
@@ -939,7 +1895,8 @@ class CreateFrame(tk.Frame):
         with self.conn as sql:
             created_success = sql.create_repair(userID=self.UserID,
                                                 **repair_info,
-                                                statusID=statusID)
+                                                statusID=statusID,
+                                                request_key=self.request_key)
         if created_success == 1:
             messagebox.showinfo(
                     messagetitle, 'Данные внесены'
@@ -994,8 +1951,15 @@ class CreateFrame(tk.Frame):
             return
         if not date_broken:
             return
-        with self.conn as sql:
-            self.allowed_objects = sql.get_object_owner_info(sn, date_broken)
+        self.allowed_objects = (self.owner_history.lookup(sn, date_broken)
+                                if self.owner_history else None)
+        if self.allowed_objects is None:
+            # history isn't available (e.g. network error)
+            with self.conn as sql:
+                self.allowed_objects = sql.get_object_owner_info(sn,
+                                                                 date_broken)
+        if self.allowed_objects is None:
+            return
         if len(self.allowed_objects) == 0:
             messagebox.showinfo(title='Нет привязки',
                 message=('В указанную дату техника не привязана ни к одному РЦ')
@@ -1034,71 +1998,29 @@ class CreateFrame(tk.Frame):
     def _validate_repair_info(self, messagetitle):
         """ Validate correctness of filled fields. Returns bool.
         """
-        try:
-            float(self.workhours.get_float_form() or 0)
-        except ValueError:
-            messagebox.showerror(
-                    messagetitle, 'Некорректно заполнено: Моточасы'
-            )
-            return False
-        try:
-            number_units = float(self.number_units.get_float_form() or 0)
-        except ValueError:
-            messagebox.showerror(
-                    messagetitle, 'Некорректно заполнено: Кол-во запчастей'
-            )
-            return False
-        if number_units and not self.units_measure.get():
-            messagebox.showerror(
-                    messagetitle, 'Не указана ед. измерения запчастей'
-            )
-            return False
-        if not self.rc.get():
-            messagebox.showerror(
-                    messagetitle, 'Не указано РЦ'
-            )
-            return False
-        if not self.store.get():
-            messagebox.showerror(
-                    messagetitle, 'Не указан склад'
-            )
-            return False
-        date_validation = self._validate_date_broken()
-        if date_validation == 'incorrect_date':
-            messagebox.showerror(
-                    messagetitle,
-                    'Дата поломки некорректна или не заполнена'
-            )
-            return False
-        elif date_validation != 'correct_date':
-            messagebox.showerror(title='Ошибка',
-                            message=('Возникло непредвиденное исключение\n{}'
-                                     .format(date_validation))
-                                )
+        message = check_repair(workhours=self.workhours.get(),
+                               number_units=self.number_units.get(),
+                               units_measure=self.units_measure.get(),
+                               rc=self.rc.get(),
+                               store=self.store.get(),
+                               date_broken=self.date_broken.get())
+        if message:
+            messagebox.showerror(messagetitle, message)
             return False
         return True
 
-    def _validate_date_broken(self):
-        """ Validate date correctness. """
-        try:
-            date_broken = self.date_broken.get()
-            self._convert_date(date_broken)
-            return 'correct_date'
-        except ValueError:
-            return 'incorrect_date'
-        except Exception as e:
-            return e
-
 
 class CreateCopyFrame(CreateFrame):
     def __init__(self, parent, conn, userID, tech_info, measure_units, objects,
-                 current_repairID):
+                 current_repairID, current_repair, owner_history=None,
+                 sn_index=None):
+        """ current_repair - tuple of _set_current_repair arguments taken
+            from loaded rows or server (see RepairApp._get_current_repair).
+        """
         super().__init__(parent, conn, userID, tech_info, measure_units,
-                         objects)
+                         objects, owner_history, sn_index)
         self.current_repairID = current_repairID
-        with self.conn as sql:
-            current_repair_info = sql.get_current_repair(self.current_repairID)
-        self._set_current_repair(*current_repair_info[0])
+        self._set_current_repair(*current_repair)
 
     def _set_current_repair(self, sn_entry, outfitorder, tech_type, model,
                             owner, mfr, date_broken, workhours, rc, store,
@@ -1131,9 +2053,11 @@ class CreateCopyFrame(CreateFrame):
 
 class UpdateRepairFrame(CreateCopyFrame):
     def __init__(self, parent, conn, userID, tech_info, measure_units, objects,
-                 repairID):
+                 repairID, current_repair, owner_history=None,
+                 sn_index=None):
         super().__init__(parent, conn, userID, tech_info, measure_units,
-                         objects)
+                         objects, repairID, current_repair,
+                         owner_history=owner_history, sn_index=sn_index)
         self.repairID = repairID
 
     def _make_buttons(self):
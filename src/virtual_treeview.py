@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jan 14 14:52:08 2020
+
+@author: v.shkaberda
+"""
+from collections import namedtuple
+from tkinter import ttk
+import tkinter as tk
+
+
+RowsDiff = namedtuple('RowsDiff', ['deleted', 'inserted', 'updated', 'order'])
+
+
+def diff_rows(shown, order, rows):
+    """ Compare rows shown in treeview with the new ones.
+
+    shown - dict {iid: (values, tags)} of shown items;
+    order - list of shown iids in their order;
+    rows - sequence of new (values, tags), the first value is a key.
+
+    Returns RowsDiff, where order is the new list of iids or None
+    if the order after deleting and appending items remains correct.
+    """
+    new_order = [str(values[0]) for values, _ in rows]
+    new_keys = set(new_order)
+    deleted = [iid for iid in order if iid not in new_keys]
+    inserted = []
+    updated = []
+    for iid, row in zip(new_order, rows):
+        old = shown.get(iid)
+        if old is None:
+            inserted.append((iid, row))
+        elif old != row:
+            updated.append((iid, row))
+    expected = [iid for iid in order if iid in new_keys]
+    expected.extend(iid for iid, _ in inserted)
+    return RowsDiff(deleted, inserted, updated,
+                    None if expected == new_order else new_order)
+
+
+def count_calls(diff):
+    """ Number of Tk calls required to apply diff. """
+    return (bool(diff.deleted) + len(diff.inserted) + len(diff.updated)
+            + (diff.order is not None))
+
+
+class VirtualTreeview(ttk.Treeview):
+    """ Treeview that is able to show large amount of rows.
+
+    When number of rows exceeds virtual_threshold, treeview holds only
+    items for visible rows plus buffer. These items are recycled while
+    scrolling and scrollbar is driven by total number of rows.
+    Rows are given to set_rows() as sequence of (values, tags),
+    the first value is used as row key to keep selection.
+    on_near_end is called without arguments when table is scrolled close
+    to the last row (e.g. to load more rows).
+    """
+    def __init__(self, master=None, *, virtual_threshold=1000, buffer=5,
+                 **kw):
+        self._yscroll = None  # scrollbar.set
+        self.on_near_end = None
+        super().__init__(master, **kw)
+        self.virtual_threshold = virtual_threshold
+        self.buffer = buffer
+        self.virtual = False
+        self.rows = []
+        self.first = 0  # index of the top shown row in virtual mode
+        self._slots = []  # iids of recycled items
+        self._shown = []  # rows currently shown in slots
+        self._selected_key = None
+        self._key_index = None  # {key: row index}, built on demand
+        # items shown in non-virtual mode: {iid: row} and iids order
+        self._items = {}
+        self._order = []
+        self.bind('<Configure>', lambda e: self.virtual and self._render())
+        self.bind('<<TreeviewSelect>>', self._on_select)
+        self.bind('<MouseWheel>', self._on_mousewheel)
+        self.bind('<Button-4>', lambda e: self._on_scroll_key(-3))
+        self.bind('<Button-5>', lambda e: self._on_scroll_key(3))
+        self.bind('<Up>', lambda e: self._on_move_key(-1))
+        self.bind('<Down>', lambda e: self._on_move_key(1))
+        self.bind('<Prior>', lambda e: self._on_move_key(-self._visible_count()))
+        self.bind('<Next>', lambda e: self._on_move_key(self._visible_count()))
+
+    def configure(self, cnf=None, **kw):
+        # scrollbar is fed by the widget itself in virtual mode
+        if 'yscrollcommand' in kw:
+            self._yscroll = kw['yscrollcommand']
+            kw['yscrollcommand'] = self._on_tk_yscroll
+        return super().configure(cnf, **kw)
+
+    config = configure
+
+    def _on_tk_yscroll(self, first, last):
+        if self.virtual:
+            return
+        if self._yscroll:
+            self._yscroll(first, last)
+        if self.on_near_end and self.rows and float(last) >= 0.9:
+            self.on_near_end()
+
+    def _on_mousewheel(self, event):
+        if self.virtual:
+            return self._on_scroll_key(-3 if event.delta > 0 else 3)
+
+    def _on_scroll_key(self, units):
+        if self.virtual:
+            self._scroll_to(self.first + units)
+            return 'break'
+
+    def _on_move_key(self, step):
+        """ Move selection with keyboard in virtual mode. """
+        if not self.virtual or not self.rows:
+            return
+        index = self._selected_index()
+        index = 0 if index is None else index + step
+        index = min(max(index, 0), len(self.rows) - 1)
+        self._selected_key = self.rows[index][0][0]
+        visible = self._visible_count()
+        if index < self.first:
+            self._scroll_to(index)
+        elif index >= self.first + visible:
+            self._scroll_to(index - visible + 1)
+        else:
+            self._render()
+        return 'break'
+
+    def _on_select(self, event):
+        if not self.virtual:
+            return
+        selection = self.selection()
+        # empty selection is set by the widget itself while scrolling
+        if selection and selection[0] in self._slots:
+            row = self._shown[self._slots.index(selection[0])]
+            self._selected_key = row[0][0]
+
+    def _scroll_to(self, first):
+        first = min(max(first, 0),
+                    max(len(self.rows) - self._visible_count(), 0))
+        if first != self.first:
+            self.first = first
+            self._render()
+
+    def _selected_index(self):
+        if self._selected_key is None:
+            return None
+        if self._key_index is None:
+            # rows formatted on demand provide keys without formatting
+            keys = getattr(self.rows, 'keys', None)
+            if keys is None:
+                keys = (row[0][0] for row in self.rows)
+            self._key_index = {key: i for i, key in enumerate(keys)}
+        return self._key_index.get(self._selected_key)
+
+    def _visible_count(self):
+        """ Number of rows fitting into the widget. """
+        bbox = self.bbox(self._slots[0]) if self._slots else ''
+        top, height = (bbox[1], bbox[3]) if bbox else (25, 20)
+        return max(1, (self.winfo_height() - top) // height)
+
+    def _reconcile(self, rows):
+        """ Update only changed items keyed by the first value in row. """
+        if len({str(row[0][0]) for row in rows}) != len(rows):
+            # keys aren't unique, so items can't be reused
+            self.delete(*self.get_children())
+            for values, tags in rows:
+                self.insert('', tk.END, values=values, tags=tags)
+            self._items, self._order = {}, list(self.get_children())
+            return
+        diff = diff_rows(self._items, self._order, rows)
+        if diff.deleted:
+            self.delete(*diff.deleted)
+        for iid, (values, tags) in diff.inserted:
+            self.insert('', tk.END, iid=iid, values=values, tags=tags)
+        for iid, (values, tags) in diff.updated:
+            self.item(iid, values=values, tags=tags)
+        if diff.order is not None:
+            self.set_children('', *diff.order)
+        self._items = {str(row[0][0]): row for row in rows}
+        self._order = (diff.order if diff.order is not None
+                       else [str(row[0][0]) for row in rows])
+
+    def _render(self):
+        """ Show rows from self.first in recycled items. """
+        window = self.rows[self.first:
+                           self.first + self._visible_count() + self.buffer]
+        while len(self._slots) < len(window):
+            self._slots.append(self.insert('', tk.END))
+            self._shown.append(None)
+        while len(self._slots) > len(window):
+            self.delete(self._slots.pop())
+            self._shown.pop()
+        selected = ()
+        for i, row in enumerate(window):
+            if self._shown[i] != row:
+                self.item(self._slots[i], values=row[0], tags=row[1])
+                self._shown[i] = row
+            if row[0][0] == self._selected_key:
+                selected = (self._slots[i],)
+        if self.selection() != selected:
+            self.selection_set(selected)
+        if selected:
+            self.focus(selected[0])
+        self._update_scrollbar()
+
+    def _update_scrollbar(self):
+        total = len(self.rows)
+        visible = self._visible_count()
+        if self.on_near_end and self.first + 2 * visible >= total:
+            self.on_near_end()
+        if not self._yscroll:
+            return
+        if total:
+            self._yscroll(self.first / total,
+                          min(1, (self.first + self._visible_count()) / total))
+        else:
+            self._yscroll(0, 1)
+
+    def focused_row(self):
+        """ Returns values of selected row or None. """
+        if self.virtual:
+            index = self._selected_index()
+            return None if index is None else self.rows[index][0]
+        cur = self.focus()
+        return self.item(cur).get('values') if cur else None
+
+    def set_rows(self, rows):
+        """ Show rows, sequence of (values, tags). """
+        virtual = len(rows) > self.virtual_threshold
+        if virtual != self.virtual:
+            self.delete(*self.get_children())
+            self._slots, self._shown = [], []
+            self._items, self._order = {}, []
+            self.first = 0
+        self.virtual = virtual
+        self.rows = rows
+        self._key_index = None
+        if virtual:
+            self.first = min(self.first, max(len(rows) - 1, 0))
+            self._render()
+        else:
+            self._reconcile(rows)
+
+    def yview(self, *args):
+        if not self.virtual:
+            return super().yview(*args)
+        if not args:
+            total = len(self.rows) or 1
+            return (self.first / total,
+                    min(1, (self.first + self._visible_count()) / total))
+        if args[0] == 'moveto':
+            self._scroll_to(int(float(args[1]) * len(self.rows)))
+        elif args[0] == 'scroll':
+            step = self._visible_count() if args[2] == 'pages' else 1
+            self._scroll_to(self.first + int(args[1]) * step)
+
+
+def benchmark_refresh(total=10000):
+    """ Print time and number of Tk calls (insert, item, delete,
+        set_children) of refreshing real table when some rows were changed:
+        full rebuild vs reconciliation. Requires display, root is withdrawn.
+    """
+    from time import perf_counter
+    root = tk.Tk()
+    root.withdraw()
+    table = VirtualTreeview(root, show='headings',
+                            virtual_threshold=total + 1)
+    table['columns'] = ('ID', 'Статус', 'Name')
+    calls = [0]
+    for name in ('insert', 'item', 'delete', 'set_children'):
+        def counted(*args, _method=getattr(table, name), **kwargs):
+            calls[0] += 1
+            return _method(*args, **kwargs)
+        setattr(table, name, counted)
+
+    def rebuild(rows):
+        """ Refresh used before: delete all items and insert rows again. """
+        table.delete(*table.get_children())
+        for values, tags in rows:
+            table.insert('', tk.END, values=values, tags=tags)
+
+    rows = [((i, 'Созд.', 'row {}'.format(i)), ('Созд.',))
+            for i in range(total)]
+    print('{:>8} {:>14} {:>12} {:>14} {:>12}'.format(
+        'changed', 'rebuild calls', 'rebuild ms', 'reconcile calls',
+        'reconcile ms'))
+    for changed in (1, 100, total):
+        new_rows = [((i, 'Фикс.', 'row {}'.format(i)), ('Фикс.',))
+                    if i < changed else rows[i] for i in range(total)]
+        result = []
+        for refresh in (rebuild, table.set_rows):
+            # the same initial state for both ways
+            table.delete(*table.get_children())
+            table._items, table._order = {}, []
+            table.set_rows(rows)
+            table.update_idletasks()
+            calls[0] = 0
+            start = perf_counter()
+            refresh(new_rows)
+            table.update_idletasks()
+            result += [calls[0], (perf_counter() - start) * 1000]
+        print('{:>8} {:>14} {:>12.1f} {:>14} {:>12.1f}'.format(changed,
+                                                               *result))
+    root.destroy()
+
+
+if __name__ == '__main__':
+    import sys
+    if '--demo' not in sys.argv:
+        benchmark_refresh()
+        sys.exit()
+    root = tk.Tk()
+    table = VirtualTreeview(root, show='headings', selectmode='browse',
+                            virtual_threshold=100)
+    table['columns'] = ('ID', 'Name')
+    for head in table['columns']:
+        table.heading(head, text=head)
+    scroll = tk.Scrollbar(root, command=table.yview)
+    table.configure(yscrollcommand=scroll.set)
+    scroll.pack(side=tk.RIGHT, fill=tk.Y)
+    table.pack(expand=True, fill=tk.BOTH)
+    table.set_rows([((i, 'row {}'.format(i)), ()) for i in range(200000)])
+    root.mainloop()